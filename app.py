@@ -1,13 +1,30 @@
+import os
+import time
+import uuid
+import logging
+
 import dash
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_daq as daq
 
-import plotly.express as px
-
-from dash.dependencies import (Input, Output, State)
-from image_ops_scratch import (ImageOperations, read_image_string)
+from flask import (Response, abort, g, has_request_context, jsonify, request)
+from dash.dependencies import (Input, Output, State, ClientsideFunction)
+from dash.exceptions import PreventUpdate
+from batch_process import BatchRunner
+from jobs import JobQueue
+from image_transport import (ResultStore, IMAGE_FORMATS, PREVIEW_SIZE, build_empty_figure, build_preview_figure, build_tiled_figure, encode_image, encode_thumbnail, fit_preview)
+from image_ops_scratch import (ImageOperations, decode_base64, decode_image_bytes)
+from progressive import proxy_level
+from image_store import (SharedImageStore, StoreFull, UploadTooLarge, content_digest)
 from image_morphs_scratch import MorphologicalTransformations
+from metrics import (RequestMetrics, slow_logger)
+from morph_ladder import MorphLadder
+from pipeline import Pipeline
+from structuring import StructuringElement
+from result_cache import ResultCache
+from tiled_exec import TiledExecutor
+from tile_pyramid import PyramidStore
 
 ########################################
 external_stylesheets = [
@@ -20,8 +37,75 @@ app.title = 'Image Processing App'
 server = app.server
 ########################################
 
+result_cache = ResultCache(
+    max_bytes=int(os.environ.get('IMAGE_APP_CACHE_MB', 256)) * 1024 ** 2,
+    spill_dir=os.environ.get('IMAGE_APP_CACHE_SPILL_DIR'),
+    spill_max_bytes=int(os.environ.get('IMAGE_APP_CACHE_SPILL_MB', 1024)) * 1024 ** 2
+)
+
+tile_executor = TiledExecutor(
+    workers=int(os.environ.get('IMAGE_APP_WORKERS', 0)) or None,
+    tile_shape=(int(os.environ.get('IMAGE_APP_TILE_ROWS', 512)), None),
+    backend=os.environ.get('IMAGE_APP_TILE_BACKEND', 'thread')
+)
+
+# 'packed' keeps square erode/dilate masks at 1 bit per pixel between
+# passes and returns uint8 results, but steps without the ladder
+morph_engine = os.environ.get('IMAGE_APP_MORPH_ENGINE', 'vhgw')
+# erode/dilate masks by level, so sweeping the morph level steps from the
+# previous level instead of recomputing
+morph_ladder = MorphLadder(max_bytes=int(os.environ.get('IMAGE_APP_LADDER_MB', 256)) * 1024 ** 2)
+
+batch_runner = BatchRunner(workers=int(os.environ.get('IMAGE_APP_BATCH_WORKERS', 0)) or None)
+
+job_queue = JobQueue(
+    workers=int(os.environ.get('IMAGE_APP_JOB_WORKERS', 2)),
+    max_result_bytes=int(os.environ.get('IMAGE_APP_JOB_RESULTS_MB', 512)) * 1024 ** 2,
+    result_ttl_seconds=int(os.environ.get('IMAGE_APP_JOB_RESULT_TTL', 600))
+)
+
+# decoded uploads kept outside the callbacks (in /dev/shm by default);
+# callbacks pass the handle of an upload instead of its base64 contents
+image_store = SharedImageStore(
+    root=os.environ.get('IMAGE_APP_SHM_DIR'),
+    max_bytes=int(os.environ.get('IMAGE_APP_SHM_MB', 1024)) * 1024 ** 2,
+    ttl_seconds=int(os.environ.get('IMAGE_APP_SHM_TTL', 3600)),
+    max_parts=int(os.environ.get('IMAGE_APP_UPLOAD_PARTS', 8))
+)
+
+# files picked in the large file input are streamed to /upload in raw
+# chunks instead of travelling as base64 in the callback JSON
+upload_max_bytes = int(os.environ.get('IMAGE_APP_UPLOAD_MB', 1024)) * 1024 ** 2
+upload_chunk_bytes = int(os.environ.get('IMAGE_APP_UPLOAD_CHUNK_MB', 8)) * 1024 ** 2
+
+result_store = ResultStore(max_bytes=int(os.environ.get('IMAGE_APP_RESULT_STORE_MB', 512)) * 1024 ** 2)
+preview_format = os.environ.get('IMAGE_APP_PREVIEW_FORMAT', 'png')
+# results larger than the preview are zoomed into through tiles of a
+# pyramid built from the stored full resolution result on demand
+tile_store = PyramidStore(
+    result_store=result_store, 
+    tile_size=int(os.environ.get('IMAGE_APP_VIEW_TILE_SIZE', 256)), 
+    fmt=preview_format,
+    max_bytes=int(os.environ.get('IMAGE_APP_VIEW_TILE_CACHE_MB', 128)) * 1024 ** 2
+)
+progressive_preview = os.environ.get('IMAGE_APP_PROGRESSIVE', '1') == '1'
+# operations simple enough to run in the browser, see assets/clientside.js
+client_ops = ('none', 'flip', 'mirror', 'invert') if os.environ.get('IMAGE_APP_CLIENT_OPS', '1') == '1' else ()
+
+request_metrics = RequestMetrics(
+    slow_seconds=float(os.environ.get('IMAGE_APP_SLOW_MS', 0)) / 1000 or None,
+    profile_rate=float(os.environ.get('IMAGE_APP_PROFILE_RATE', 0.1))
+)
+if os.environ.get('IMAGE_APP_SLOW_LOG'):
+    slow_logger.addHandler(logging.FileHandler(os.environ['IMAGE_APP_SLOW_LOG']))
+
 image_ops = ['None', 'Equalize', 'Flip', 'Mirror', 'Binarize', 'Invert', 'Solarize']
 image_morphs = ['None', 'Erode', 'Dilate', 'Open', 'Close', 'Gradient', 'Boundary Extraction']
+morph_shapes = [
+    ('Square', 'square'), ('Cross', 'cross'), ('Disk', 'disk'), 
+    ('Line -', 'line-0'), ('Line |', 'line-90'), ('Line /', 'line-45'), ('Line \\', 'line-135'), 
+    ('Custom', 'custom')
+]
 
 tab_style = {
     'borderBottom': '1px solid #d6d6d6',
@@ -37,7 +121,7 @@ tab_selected_style = {
     'padding': '6px'
 }
 
-app.layout = html.Div([
+base_layout = html.Div([
     html.Meta(charSet='UTF-8'),
     html.Meta(name='viewport', content='width=device-width, initial-scale=1.0'),
 
@@ -69,6 +153,12 @@ app.layout = html.Div([
                 },
                 multiple=True
             ),
+            html.Div([
+                html.Button('Upload large file', id='stream-upload-button', n_clicks=0),
+                html.Small(id='stream-status', className='stream-status'),
+                dcc.Store(id='stream-handle'),
+                dcc.Store(id='stream-config', data={'chunk_bytes' : upload_chunk_bytes}),
+            ], className='stream-upload'),
         ], style={'paddingTop' : 50}),
         html.Div([
             dcc.Tabs(
@@ -108,7 +198,18 @@ app.layout = html.Div([
                         children=[
                             html.Div([
                                 html.P('Morph level - '),
-                                dcc.Input(id='morph-level', type='number', placeholder='Enter Morph Level - ', value=3),
+                                html.Div([
+                                    dcc.Input(id='morph-level', type='number', placeholder='Enter Morph Level - ', value=3),
+                                    dcc.Dropdown(
+                                        id='morph-shape', 
+                                        options=[{'label' : label, 'value' : value} for label, value in morph_shapes],
+                                        value='square', clearable=False, className='morph-shape'
+                                    ),
+                                ], className='morph-settings'),
+                                dcc.Input(
+                                    id='morph-footprint', type='text', debounce=True, 
+                                    placeholder='Rows of 0/1, e.g. 010;111;010', style={'display' : 'none'}
+                                ),
                                 html.Div([
                                     dcc.RadioItems(
                                         id='in-transformation', 
@@ -118,20 +219,393 @@ app.layout = html.Div([
                                 ], style={'paddingTop' : 20})
                             ], className='select-operation')
                         ]
+                    ),
+                    dcc.Tab(
+                        label='Pipeline',
+                        value='pipeline',
+                        style=tab_style,
+                        selected_style=tab_selected_style,
+                        children=[
+                            html.Div([
+                                html.P('Steps - '),
+                                dcc.Input(
+                                    id='pipeline-spec', type='text', debounce=True, 
+                                    placeholder='equalize > binarize > open:5 > boundary', 
+                                    className='pipeline-spec'
+                                ),
+                                html.Div(id='pipeline-plan', className='pipeline-plan')
+                            ], className='select-operation')
+                        ]
                     )
                 ]
             )
         ], className='tab-div')
     ], className='flex-item-left'),
 
-    html.Div(id='result-in-out-image', className='flex-item-right'),
+    html.Div([
+        html.Div(id='result-in-out-image'),
+        html.Div(id='batch-gallery', className='batch-gallery'),
+        dcc.Store(id='batch-id'),
+        dcc.Store(id='batch-contents'),
+        dcc.Store(id='upload-first'),
+        dcc.Store(id='image-handle'),
+        dcc.Store(id='client-ops', data={'ops' : client_ops, 'max_size' : PREVIEW_SIZE}),
+        dcc.Interval(id='batch-poll', interval=500, disabled=True),
+    ], className='flex-item-right'),
 
 ], className='flex-container')
 
 
-def parse_contents(contents, filename, date):
-    image_mat = read_image_string(contents=contents)
-    return image_mat
+def serve_layout():
+    # every page load gets its own session id, so a newer request can
+    # cancel the background job of an older one from the same page
+    return html.Div([base_layout, dcc.Store(id='session-id', data=uuid.uuid4().hex)])
+
+
+app.layout = serve_layout
+
+
+@server.route('/download/<token>')
+def download_result(token):
+    image_src = result_store.get(token=token)
+    if image_src is None:
+        abort(404)
+    return Response(
+        encode_image(image_src=image_src, fmt='png'), 
+        mimetype=IMAGE_FORMATS['png'][1], 
+        headers={'Content-Disposition' : 'attachment; filename=result-{}.png'.format(token[:8])}
+    )
+
+
+def stats_collector(prefix, label, stats, counters):
+    # /metrics collector of a component's stats(): `counters` are exported
+    # as _total counters, everything else as gauges
+    def collect():
+        for name, value in stats().items():
+            help_text = '{} {}.'.format(label, name.replace('_', ' '))
+            if name in counters:
+                yield 'image_app_{}_{}_total'.format(prefix, name), 'counter', help_text, value
+            else:
+                yield 'image_app_{}_{}'.format(prefix, name), 'gauge', help_text, value
+    return collect
+
+
+for collector in (
+    stats_collector(prefix='cache', label='Result cache', stats=result_cache.stats, counters=('hits', 'misses', 'disk_hits', 'evictions')),
+    stats_collector(prefix='ladder', label='Morph ladder', stats=morph_ladder.stats, counters=('hits', 'steps', 'misses', 'evictions')),
+    stats_collector(prefix='image_store', label='Shared image store', stats=image_store.stats, counters=('hits', 'misses', 'evictions')),
+    stats_collector(prefix='view_tile', label='Viewer tile cache', stats=tile_store.stats, counters=('hits', 'misses')),
+):
+    request_metrics.registry.add_collector(collector)
+
+
+@server.route('/tiles/<token>/info')
+def tile_info(token):
+    info = tile_store.info(token=token)
+    if info is None:
+        abort(404)
+    return jsonify(info)
+
+
+@server.route('/tiles/<token>/<int:level>/<int:row>/<int:col>')
+def view_tile(token, level, row, col):
+    # computed and encoded the first time it is asked for; a token always
+    # names the same result, so browsers may keep tiles
+    try:
+        encoded = tile_store.tile_bytes(token=token, level=level, row=row, col=col)
+    except ValueError:
+        abort(404)
+    if encoded is None:
+        abort(404)
+    response = Response(encoded, mimetype=tile_store.mimetype())
+    response.headers['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+
+@server.route('/upload/<upload_id>', methods=['PUT'])
+def receive_upload_chunk(upload_id):
+    # raw bytes of one chunk, appended at ?offset=; the body is copied to
+    # disk as it arrives, never read into memory as a whole
+    try:
+        received = image_store.append_part(
+            upload_id=upload_id, offset=int(request.args.get('offset', 0)), 
+            stream=request.stream, max_bytes=upload_max_bytes
+        )
+    except UploadTooLarge as error:
+        image_store.discard_part(upload_id=upload_id)
+        return jsonify(error=str(error)), 413
+    except StoreFull as error:
+        image_store.discard_part(upload_id=upload_id)
+        return jsonify(error=str(error)), 507
+    except ValueError as error:
+        return jsonify(error=str(error)), 400
+    return jsonify(received=received)
+
+
+@server.route('/upload/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    # decodes the streamed file straight from a memory map of it and
+    # returns the handle the processing callbacks take
+    try:
+        with traced(callback='stream_upload') as trace:
+            with trace.stage('hash'):
+                handle = image_store.part_digest(upload_id=upload_id)
+            if not (image_store.contains(handle=handle) and image_store.contains(handle=handle, variant='proxy')):
+                with trace.stage('imdecode'):
+                    imsrc = decode_image_bytes(nparr=image_store.map_part(upload_id=upload_id))
+                trace.set_shape(imsrc.shape)
+                store_decoded(trace=trace, handle=handle, imsrc=imsrc)
+    except (OSError, ValueError) as error:
+        return jsonify(error=str(error)), 400
+    finally:
+        image_store.discard_part(upload_id=upload_id)
+    return jsonify(handle=handle)
+
+
+@server.route('/metrics')
+def export_metrics():
+    return Response(request_metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def traced(callback, **info):
+    trace = request_metrics.trace(callback=callback, **info)
+    if has_request_context():
+        # Dash serializes the returned layout after the callback, so the
+        # trace is finished by finish_traces once the response exists.
+        trace.deferred = True
+        g.setdefault('traces', []).append(trace)
+    return trace
+
+
+@server.after_request
+def finish_traces(response):
+    for trace in g.pop('traces', []):
+        trace.finish(response_bytes=response.content_length, serialize=(time.perf_counter() - trace.end))
+    return response
+
+
+def decode_traced(trace, content):
+    with trace.stage('decode_base64'):
+        nparr = decode_base64(content=content)
+    with trace.stage('imdecode'):
+        imsrc = decode_image_bytes(nparr=nparr)
+    trace.set_shape(imsrc.shape)
+    return imsrc
+
+
+def store_decoded(trace, handle, imsrc):
+    with trace.stage('store'):
+        imsrc = image_store.put(handle=handle, image_src=imsrc)
+        image_store.put(handle=handle, image_src=fit_preview(image_src=imsrc), variant='proxy')
+    return imsrc
+
+
+def load_upload(trace, handle, variant='full'):
+    # the decoded upload mapped from the shared store, with its handle as
+    # the result cache digest so its pixels are never hashed
+    with trace.stage('load'):
+        imsrc = image_store.get(handle=handle, variant=variant)
+    if imsrc is None:
+        raise ValueError('The uploaded image expired - upload it again')
+    result_cache.remember_digest(image_src=imsrc, digest='{}:{}'.format(handle, variant))
+    if variant == 'full':
+        trace.set_shape(imsrc.shape)
+    return imsrc
+
+
+def load_proxy(trace, handle):
+    # the preview sized proxy and its scale relative to the full image
+    proxy = load_upload(trace=trace, handle=handle, variant='proxy')
+    imsrc = load_upload(trace=trace, handle=handle)
+    return proxy, proxy.shape[1] / float(imsrc.shape[1])
+
+
+def render_full(out_img):
+    # the browser only gets a downscaled PNG/WebP preview, the full
+    # resolution result stays on the server behind a download link.
+    token = result_store.put(image_src=out_img)
+    height, width = out_img.shape[:2]
+    if (width > PREVIEW_SIZE[0]) or (height > PREVIEW_SIZE[1]):
+        out_image_fig = build_tiled_figure(
+            image_src=out_img, tiles_url='/tiles/{}'.format(token), 
+            pyramid_info=tile_store.info(token=token), fmt=preview_format
+        )
+    else:
+        out_image_fig = build_preview_figure(image_src=out_img, fmt=preview_format)
+    return out_image_fig, None, '/download/{}'.format(token), {}
+
+
+def render_result(out_img, prefix, pending=None):
+    # with `pending` set, out_img is a proxy result (or None) and the store
+    # holds what the full resolution job still has to compute.
+    if pending is None:
+        out_image_fig, progress, href, link_style = render_full(out_img=out_img)
+    else:
+        if out_img is None:
+            out_image_fig, progress = build_empty_figure(), 'Computing full resolution ...'
+        else:
+            out_image_fig, progress = build_preview_figure(image_src=out_img, fmt=preview_format), 'Preview - computing full resolution ...'
+        href, link_style = None, {'display' : 'none'}
+
+    output_result = html.Div([
+        dcc.Graph(id='out-{}-img'.format(prefix), figure=out_image_fig),
+        html.Small(progress, id='{}-progress'.format(prefix)),
+        html.A(
+            'Download full resolution', id='{}-download'.format(prefix), 
+            href=href, style=link_style, className='download-link'
+        ),
+        dcc.Store(id='{}-full-request'.format(prefix), data=pending),
+        dcc.Store(id='{}-job'.format(prefix)),
+        dcc.Interval(id='{}-job-poll'.format(prefix), interval=500, disabled=(pending is None))
+    ], style={'paddingTop' : 50})
+    return output_result
+
+
+def start_full_job(callback, session, handle, compute, **info):
+    # the full resolution pass runs on the job queue instead of blocking
+    # the request; a newer request of the same session cancels it at the
+    # next planner node, tile or pipeline stage.
+    def run_job():
+        with traced(callback=callback, **info) as trace:
+            imsrc = load_upload(trace=trace, handle=handle)
+            with trace.stage('compute'):
+                return compute(imsrc)
+    return job_queue.submit(func=run_job, session=session)
+
+
+def poll_full_job(job_id):
+    # figure, progress, download href, download style and whether to stop polling
+    job = job_queue.poll(job_id=job_id)
+    if job is None:
+        return dash.no_update, 'Result expired - change a setting to compute it again', dash.no_update, dash.no_update, True
+    if job['status'] in ('queued', 'running'):
+        progress = 'Preview - computing full resolution ... {:.0f} s'.format(job['elapsed'])
+        return dash.no_update, progress, dash.no_update, dash.no_update, False
+
+    job_queue.forget(job_id=job_id)
+    if job['status'] == 'done':
+        return render_full(out_img=job['result']) + (True, )
+    if job['status'] == 'cancelled':
+        return dash.no_update, 'Superseded by a newer request', dash.no_update, dash.no_update, True
+    return dash.no_update, 'Failed - {}'.format(job['error']), dash.no_update, dash.no_update, True
+
+
+for prefix in ('op', 'morph', 'pipeline'):
+    # swaps in the pyramid tiles covering the zoomed viewport
+    app.clientside_callback(
+        ClientsideFunction(namespace='image_tiles', function_name='show_viewport'),
+        Output('out-{}-img'.format(prefix), 'figure', allow_duplicate=True),
+        [
+            Input('out-{}-img'.format(prefix), 'relayoutData'), 
+            # -------
+            State('out-{}-img'.format(prefix), 'figure'), 
+        ],
+        prevent_initial_call=True
+    )
+
+
+def apply_operation(imsrc, operation, image_mode):
+    imo = ImageOperations(image_file_src=imsrc, cache=result_cache, executor=tile_executor)
+    if (operation == 'equalize'):
+        out_img = imo.equalize_this(gray_scale=True) if image_mode else imo.equalize_this()
+    elif (operation == 'flip'):
+        out_img = imo.flip_this(gray_scale=True) if image_mode else imo.flip_this()
+    elif (operation == 'mirror'):
+        out_img = imo.mirror_this(gray_scale=True) if image_mode else imo.mirror_this()
+    elif (operation == 'binarize'):
+        out_img = imo.binarize_this(gray_scale=True) if image_mode else imo.binarize_this()
+    elif (operation == 'invert'):
+        out_img = imo.invert_this(gray_scale=True) if image_mode else imo.invert_this()
+    elif (operation == 'solarize'):
+        out_img = imo.solarize_this(gray_scale=True) if image_mode else imo.solarize_this()
+    else:
+        out_img = imo.read_this(gray_scale=True) if image_mode else imo.read_this()
+    return out_img
+
+
+def make_element(shape, footprint):
+    # shape names are sized by the morph level, a custom element is typed
+    # as rows of 0/1
+    if shape == 'custom':
+        return StructuringElement.parse(text=(footprint or ''))
+    return shape or 'square'
+
+
+def apply_transformation(imsrc, transformation, level, shape='square', footprint=None):
+    morph = MorphologicalTransformations(
+        image_file_src=imsrc, level=level, engine=morph_engine, cache=result_cache, executor=tile_executor, 
+        shape=make_element(shape=shape, footprint=footprint), ladder=morph_ladder
+    )
+    image_src = morph.read_this()
+
+    if (transformation == 'erode'):
+        out_img = morph.erode_image(image_src=image_src)
+    elif (transformation == 'dilate'):
+        out_img = morph.dilate_image(image_src=image_src)
+    elif (transformation == 'open'):
+        out_img = morph.open_image(image_src=image_src)
+    elif (transformation == 'close'):
+        out_img = morph.close_image(image_src=image_src)
+    elif (transformation == 'gradient'):
+        out_img = morph.morph_gradient(image_src=image_src)
+    elif (transformation == 'boundary extraction'):
+        out_img = morph.extract_boundary(image_src=image_src)
+    else:
+        out_img = image_src
+    return out_img
+
+
+# the upload is split in the browser, so the server gets the first file
+# once for the single image views and the whole set only for a batch
+app.clientside_callback(
+    ClientsideFunction(namespace='image_upload', function_name='split_upload'),
+    [
+        Output('upload-first', 'data'), 
+        Output('batch-contents', 'data'), 
+    ],
+    [Input('upload-image', 'contents')]
+)
+
+
+@app.callback(
+    Output('image-handle', 'data'),
+    [
+        Input('upload-first', 'data'), 
+        Input('stream-handle', 'data'), 
+    ]
+)
+def store_upload(content, stream):
+    # the only callback that receives the upload itself; the full image and
+    # its preview sized proxy are decoded once into the shared store. A
+    # streamed upload arrives already stored, as a handle from /upload.
+    triggered = [trigger['prop_id'] for trigger in dash.callback_context.triggered]
+    if 'stream-handle.data' in triggered:
+        if stream is None:
+            raise PreventUpdate
+        return stream['handle']
+    if content is None:
+        raise PreventUpdate
+    handle = content_digest(content=content)
+    if image_store.contains(handle=handle) and image_store.contains(handle=handle, variant='proxy'):
+        return handle
+    with traced(callback='store_upload') as trace:
+        imsrc = decode_traced(trace=trace, content=content)
+        store_decoded(trace=trace, handle=handle, imsrc=imsrc)
+    return handle
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='image_upload', function_name='stream_file'),
+    [
+        Output('stream-handle', 'data'), 
+        Output('stream-status', 'children'), 
+    ],
+    [
+        Input('stream-upload-button', 'n_clicks'), 
+        # -------
+        State('stream-config', 'data'), 
+    ]
+)
 
 
 @app.callback(
@@ -144,10 +618,11 @@ def set_output_layout(which_tab):
             html.Div( 
                 children= [
                     html.H5('Image Used - Output'),
-                    dcc.Loading(
-                        id='loading-op',
-                        type='dot',
-                        children=html.Div(id='output-image-op')
+                    html.Div(id='output-image-op'),
+                    dcc.Store(id='op-request'),
+                    html.Div(
+                        dcc.Graph(id='client-op-img', figure=build_empty_figure()), 
+                        id='client-op-result', style={'display' : 'none'}
                     )
                 ],
                 style={'textAlign' : 'center', 'paddingTop' : 50}
@@ -158,11 +633,17 @@ def set_output_layout(which_tab):
             html.Div( 
                 children= [
                     html.H5('Image Used - Output'),
-                    dcc.Loading(
-                        id='loading-morph',
-                        type='dot',
-                        children=html.Div(id='output-image-morph')
-                    )
+                    html.Div(id='output-image-morph')
+                ],
+                style={'textAlign' : 'center', 'paddingTop' : 50}
+            )
+        ])
+    elif which_tab == 'pipeline':
+        in_out_image_div = html.Div([
+            html.Div( 
+                children= [
+                    html.H5('Image Used - Output'),
+                    dcc.Loading(id='loading-pipeline', type='dot', children=html.Div(id='output-image-pipeline'))
                 ],
                 style={'textAlign' : 'center', 'paddingTop' : 50}
             )
@@ -170,99 +651,321 @@ def set_output_layout(which_tab):
     return in_out_image_div
 
 
+# operations in client_ops are drawn by the browser into client-op-result;
+# only the others are written to op-request for the server
+app.clientside_callback(
+    ClientsideFunction(namespace='image_ops', function_name='route_operation'),
+    [
+        Output('op-request', 'data'), 
+        Output('output-image-op', 'style'), 
+    ],
+    [
+        Input('image-handle', 'data'), 
+        Input('image-mode', 'value'), 
+        Input('in-operation', 'value'), 
+        # -------
+        State('client-ops', 'data'), 
+    ]
+)
+
+
 @app.callback(
     Output('output-image-op', 'children'), 
+    [
+        Input('op-request', 'data'), 
+        # -------
+        State('upload-image', 'filename'), 
+        State('upload-image', 'last_modified'), 
+        State('session-id', 'data'), 
+    ]
+)
+def get_operated_image(request, filenames, dates, session):
+    if request is not None:
+        handle, image_mode, operation = request['handle'], request['image_mode'], request['operation']
+        job_queue.cancel_session(session=session)
+        mode = 'gray' if image_mode else 'color'
+        pending = {'operation' : operation, 'image_mode' : image_mode}
+        with traced(callback='get_operated_image', operation=operation, mode=mode) as trace:
+            if not progressive_preview:
+                return render_result(out_img=None, prefix='op', pending=pending)
+            try:
+                imsrc, scale = load_proxy(trace=trace, handle=handle)
+            except ValueError as error:
+                return html.Small(str(error), className='batch-error')
+            with trace.stage('compute'):
+                out_img = apply_operation(imsrc=imsrc, operation=operation, image_mode=image_mode)
+            with trace.stage('figure'):
+                # a proxy at scale 1.0 is already the full resolution result
+                return render_result(out_img=out_img, prefix='op', pending=(pending if scale < 1.0 else None))
+
+
+app.clientside_callback(
+    ClientsideFunction(namespace='image_ops', function_name='apply_operation'),
+    [
+        Output('client-op-img', 'figure'), 
+        Output('client-op-result', 'style'), 
+    ],
     [
         Input('upload-image', 'contents'), 
+        Input('stream-handle', 'data'), 
         Input('image-mode', 'value'), 
         Input('in-operation', 'value'), 
         # -------
-        State('upload-image', 'filename'), 
-        State('upload-image', 'last_modified'), 
+        State('client-ops', 'data'), 
     ]
 )
-def get_operated_image(contents, image_mode, operation, filenames, dates):
-    if contents is not None:
-        imsrc = parse_contents(contents, filenames, dates)
-        imo = ImageOperations(image_file_src=imsrc)
-        if (operation == 'equalize'):
-            out_img = imo.equalize_this(gray_scale=True) if image_mode else imo.equalize_this()
-        elif (operation == 'flip'):
-            out_img = imo.flip_this(gray_scale=True) if image_mode else imo.flip_this()
-        elif (operation == 'mirror'):
-            out_img = imo.mirror_this(gray_scale=True) if image_mode else imo.mirror_this()
-        elif (operation == 'binarize'):
-            out_img = imo.binarize_this(gray_scale=True) if image_mode else imo.binarize_this()
-        elif (operation == 'invert'):
-            out_img = imo.invert_this(gray_scale=True) if image_mode else imo.invert_this()
-        elif (operation == 'solarize'):
-            out_img = imo.solarize_this(gray_scale=True) if image_mode else imo.solarize_this()
-        else:
-            out_img = imo.read_this(gray_scale=True) if image_mode else imo.read_this()
 
-        out_image_fig = px.imshow(out_img, color_continuous_scale='gray') if image_mode else px.imshow(out_img)
-        out_image_fig.update_layout(
-            coloraxis_showscale=False, 
-            width=600, height=400, 
-            margin=dict(l=0, r=0, b=0, t=0)
-        )
-        out_image_fig.update_xaxes(showticklabels=False)
-        out_image_fig.update_yaxes(showticklabels=False)
 
-        output_result = html.Div([
-            dcc.Graph(id='out-op-img', figure=out_image_fig)
-        ], style={'paddingTop' : 50})
+@app.callback(
+    Output('op-job', 'data'),
+    [
+        Input('op-full-request', 'data'), 
+        # -------
+        State('image-handle', 'data'), 
+        State('session-id', 'data'), 
+    ]
+)
+def complete_operated_image(pending, handle, session):
+    if (pending is None) or (handle is None):
+        raise PreventUpdate
+    return start_full_job(
+        callback='complete_operated_image', session=session, handle=handle, 
+        compute=lambda imsrc: apply_operation(imsrc=imsrc, operation=pending['operation'], image_mode=pending['image_mode']), 
+        operation=pending['operation'], mode=('gray' if pending['image_mode'] else 'color')
+    )
+
+
+@app.callback(
+    [
+        Output('out-op-img', 'figure'), 
+        Output('op-progress', 'children'), 
+        Output('op-download', 'href'), 
+        Output('op-download', 'style'), 
+        Output('op-job-poll', 'disabled'), 
+    ],
+    [
+        Input('op-job-poll', 'n_intervals'), 
+        # -------
+        State('op-job', 'data'), 
+    ]
+)
+def poll_operated_image(n_intervals, job_id):
+    if job_id is None:
+        raise PreventUpdate
+    return poll_full_job(job_id=job_id)
+
 
-        return output_result
+@app.callback(
+    Output('morph-footprint', 'style'),
+    [Input('morph-shape', 'value')]
+)
+def show_footprint_input(shape):
+    return {'display' : 'block', 'marginTop' : 10} if shape == 'custom' else {'display' : 'none'}
 
 
 @app.callback(
     Output('output-image-morph', 'children'),
     [
-        Input('upload-image', 'contents'), 
+        Input('image-handle', 'data'), 
         Input('morph-level', 'value'), 
         Input('in-transformation', 'value'),
+        Input('morph-shape', 'value'), 
+        Input('morph-footprint', 'value'), 
         # -------
         State('upload-image', 'filename'), 
         State('upload-image', 'last_modified'), 
+        State('session-id', 'data'), 
     ]
 )
-def get_transformed_image(contents, level, transformation, filenames, dates):
-    if contents is not None:
-        imsrc = parse_contents(contents, filenames, dates)
-        morph = MorphologicalTransformations(image_file_src=imsrc, level=level)
-        level = 3 if level == None else level
-        image_src = morph.read_this()
-
-        if (transformation == 'erode'):
-            out_img = morph.erode_image(image_src=image_src)
-        elif (transformation == 'dilate'):
-            out_img = morph.dilate_image(image_src=image_src)
-        elif (transformation == 'open'):
-            out_img = morph.open_image(image_src=image_src)
-        elif (transformation == 'close'):
-            out_img = morph.close_image(image_src=image_src)
-        elif (transformation == 'gradient'):
-            out_img = morph.morph_gradient(image_src=image_src)
-        elif (transformation == 'boundary extraction'):
-            out_img = morph.extract_boundary(image_src=image_src)
-        else:
-            out_img = image_src
+def get_transformed_image(handle, level, transformation, shape, footprint, filenames, dates, session):
+    if handle is not None:
+        job_queue.cancel_session(session=session)
+        try:
+            make_element(shape=shape, footprint=footprint)
+        except ValueError as error:
+            return html.Small(str(error), className='batch-error')
+        pending = {'transformation' : transformation, 'level' : level, 'shape' : shape, 'footprint' : footprint}
+        with traced(
+            callback='get_transformed_image', operation=transformation, mode='gray', level=level, shape=shape
+        ) as trace:
+            if not progressive_preview:
+                return render_result(out_img=None, prefix='morph', pending=pending)
+            try:
+                imsrc, scale = load_proxy(trace=trace, handle=handle)
+            except ValueError as error:
+                return html.Small(str(error), className='batch-error')
+            with trace.stage('compute'):
+                out_img = apply_transformation(
+                    imsrc=imsrc, transformation=transformation, level=proxy_level(level=level, scale=scale), 
+                    shape=shape, footprint=footprint
+                )
+            with trace.stage('figure'):
+                return render_result(out_img=out_img, prefix='morph', pending=(pending if scale < 1.0 else None))
 
-        out_image_fig = px.imshow(out_img, color_continuous_scale='gray')
-        out_image_fig.update_layout(
-            coloraxis_showscale=False, 
-            width=600, height=400, 
-            margin=dict(l=0, r=0, b=0, t=0)
+
+@app.callback(
+    Output('morph-job', 'data'),
+    [
+        Input('morph-full-request', 'data'), 
+        # -------
+        State('image-handle', 'data'), 
+        State('session-id', 'data'), 
+    ]
+)
+def complete_transformed_image(pending, handle, session):
+    if (pending is None) or (handle is None):
+        raise PreventUpdate
+    return start_full_job(
+        callback='complete_transformed_image', session=session, handle=handle, 
+        compute=lambda imsrc: apply_transformation(
+            imsrc=imsrc, transformation=pending['transformation'], level=pending['level'], 
+            shape=pending['shape'], footprint=pending['footprint']
+        ), 
+        operation=pending['transformation'], mode='gray', level=pending['level'], shape=pending['shape']
+    )
+
+
+@app.callback(
+    [
+        Output('out-morph-img', 'figure'), 
+        Output('morph-progress', 'children'), 
+        Output('morph-download', 'href'), 
+        Output('morph-download', 'style'), 
+        Output('morph-job-poll', 'disabled'), 
+    ],
+    [
+        Input('morph-job-poll', 'n_intervals'), 
+        # -------
+        State('morph-job', 'data'), 
+    ]
+)
+def poll_transformed_image(n_intervals, job_id):
+    if job_id is None:
+        raise PreventUpdate
+    return poll_full_job(job_id=job_id)
+
+
+def apply_pipeline(imsrc, spec):
+    # the steps are fused and reordered before running, see Pipeline.optimize
+    return Pipeline.from_text(text=spec or '', executor=tile_executor).run(image_file_src=imsrc)
+
+
+@app.callback(
+    Output('pipeline-plan', 'children'),
+    [Input('pipeline-spec', 'value')]
+)
+def show_pipeline_plan(spec):
+    try:
+        plan = Pipeline.from_text(text=spec or '').describe()
+    except ValueError as error:
+        return html.Small(str(error), className='batch-error')
+    return html.Small('Runs as - {}'.format(plan))
+
+
+@app.callback(
+    Output('output-image-pipeline', 'children'),
+    [
+        Input('image-handle', 'data'), 
+        Input('pipeline-spec', 'value'), 
+    ]
+)
+def get_pipeline_image(handle, spec):
+    if handle is None:
+        raise PreventUpdate
+    try:
+        pipeline = Pipeline.from_text(text=spec or '', executor=tile_executor)
+    except ValueError:
+        # an unfinished spec is reported by show_pipeline_plan
+        raise PreventUpdate
+    with traced(callback='get_pipeline_image', steps=pipeline.to_text()) as trace:
+        try:
+            imsrc = load_upload(trace=trace, handle=handle)
+        except ValueError as error:
+            return html.Small(str(error), className='batch-error')
+        with trace.stage('compute'):
+            out_img = pipeline.run(image_file_src=imsrc)
+        with trace.stage('figure'):
+            return render_result(out_img=out_img, prefix='pipeline')
+
+
+def render_batch_item(record):
+    if record['status'] == 'error':
+        details = [html.P(record['filename']), html.Small('Failed - {}'.format(record['error']))]
+        return html.Div(details, className='batch-item batch-error')
+    details = [
+        html.Img(src=record['result']),
+        html.P(record['filename']),
+        html.Small('{} x {} - decode {:.0f} ms, process {:.0f} ms'.format(
+            record['shape'][1], record['shape'][0], record['decode_ms'], record['process_ms']
+        ))
+    ]
+    return html.Div(details, className='batch-item')
+
+
+def render_batch(records, count):
+    return html.Div([
+        html.H5('Batch - {} of {} files processed'.format(len(records), count)),
+        html.Div([render_batch_item(record=record) for record in records])
+    ])
+
+
+@app.callback(
+    [
+        Output('batch-id', 'data'), 
+        Output('batch-gallery', 'children'), 
+        Output('batch-poll', 'disabled'), 
+    ],
+    [
+        Input('batch-contents', 'data'), 
+        # -------
+        State('upload-image', 'filename'), 
+        State('image-processors-tabs', 'value'), 
+        State('image-mode', 'value'), 
+        State('in-operation', 'value'), 
+        State('morph-level', 'value'), 
+        State('in-transformation', 'value'), 
+        State('morph-shape', 'value'), 
+        State('morph-footprint', 'value'), 
+        State('pipeline-spec', 'value'), 
+    ]
+)
+def submit_batch(contents, filenames, which_tab, image_mode, operation, level, transformation, shape, footprint, spec):
+    # the files arrive here once; polling only carries the batch id
+    if not contents:
+        return None, None, True
+    if which_tab == 'transformers':
+        process = lambda imsrc: encode_thumbnail(
+            image=apply_transformation(
+                imsrc=imsrc, transformation=transformation, level=level, shape=shape, footprint=footprint
+            )
         )
-        out_image_fig.update_xaxes(showticklabels=False)
-        out_image_fig.update_yaxes(showticklabels=False)
+    elif which_tab == 'pipeline':
+        process = lambda imsrc: encode_thumbnail(image=apply_pipeline(imsrc=imsrc, spec=spec))
+    else:
+        process = lambda imsrc: encode_thumbnail(
+            image=apply_operation(imsrc=imsrc, operation=operation, image_mode=image_mode)
+        )
+    batch_id = batch_runner.submit(contents=contents, filenames=filenames, process=process)
+    return {'id' : batch_id, 'count' : len(contents)}, render_batch(records=[], count=len(contents)), False
 
-        output_result = html.Div([
-            dcc.Graph(id='out-morph-img', figure=out_image_fig)
-        ], style={'paddingTop' : 50})
 
-        return output_result
+@app.callback(
+    [
+        Output('batch-gallery', 'children', allow_duplicate=True), 
+        Output('batch-poll', 'disabled', allow_duplicate=True), 
+    ],
+    [
+        Input('batch-poll', 'n_intervals'), 
+        # -------
+        State('batch-id', 'data'), 
+    ],
+    prevent_initial_call=True
+)
+def poll_batch(n_intervals, batch):
+    if batch is None:
+        return None, True
+    records, done = batch_runner.poll(batch_id=batch['id'])
+    return render_batch(records=records, count=batch['count']), done
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,302 @@
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    image_ops: {
+        // Operations listed in config.ops are pure pixel reorderings or
+        // negations, so they run here on the uploaded image instead of
+        // sending it to the server. The result is drawn at preview size.
+        apply_operation: function(contents, stream, image_mode, operation, config) {
+            var hidden = {'display': 'none'};
+            var source = latest_source(contents, stream);
+            if (!source || !config || (config.ops.indexOf(operation) < 0)) {
+                return [window.dash_clientside.no_update, hidden];
+            }
+
+            return new Promise(function(resolve) {
+                var image = new Image();
+                image.onload = function() {
+                    resolve([
+                        preview_figure(render_operation(image, operation, image_mode, config.max_size)),
+                        {'display': 'block', 'paddingTop': 50}
+                    ]);
+                };
+                image.onerror = function() {
+                    resolve([window.dash_clientside.no_update, hidden]);
+                };
+                image.src = source;
+            });
+        },
+
+        // The server only hears about operations it has to compute, so
+        // picking one of config.ops costs no round trip at all.
+        route_operation: function(handle, image_mode, operation, config) {
+            var no_update = window.dash_clientside.no_update;
+            if (!handle || !config) {
+                return [no_update, no_update];
+            }
+            if (config.ops.indexOf(operation) >= 0) {
+                return [no_update, {'display': 'none'}];
+            }
+            return [{'handle': handle, 'image_mode': image_mode, 'operation': operation}, {'display': 'block'}];
+        }
+    },
+
+    image_upload: {
+        // The first file goes to store_upload and a multi-file drop to the
+        // batch, so neither callback is sent files it does not use.
+        split_upload: function(contents) {
+            if (!contents) {
+                return [window.dash_clientside.no_update, null];
+            }
+            return [contents[0], (contents.length > 1) ? contents : null];
+        },
+
+        // Lets the user pick a file and sends it to /upload in raw chunks
+        // of config.chunk_bytes, so large scans never go through base64 or
+        // the callback JSON, then hands the returned handle to store_upload.
+        stream_file: function(n_clicks, config) {
+            var no_update = window.dash_clientside.no_update;
+            if (!n_clicks) {
+                return [no_update, no_update];
+            }
+            return pick_file().then(function(file) {
+                if (!file) {
+                    return [no_update, no_update];
+                }
+                return send_file(file, config.chunk_bytes).then(function(reply) {
+                    // the browser side operations read the local file, not the server
+                    var stream = {'handle': reply.handle, 'url': URL.createObjectURL(file), 'name': file.name};
+                    return [stream, file.name + ' uploaded'];
+                });
+            }).catch(function(error) {
+                return [no_update, 'Upload failed - ' + error.message];
+            });
+        }
+    },
+
+    image_tiles: {
+        // Results larger than the preview carry their tile pyramid in
+        // layout.meta (image_transport.build_tiled_figure). On every zoom or
+        // pan the tiles of the level that matches the screen resolution
+        // are laid over the preview, only those inside the viewport.
+        show_viewport: function(relayout, figure) {
+            var no_update = window.dash_clientside.no_update;
+            var meta = figure && figure.layout && figure.layout.meta;
+            if (!relayout || !meta || !meta.tiles) {
+                return no_update;
+            }
+            var x_range = viewport_range(relayout, 'xaxis', meta.width);
+            if (!x_range) {
+                return no_update;
+            }
+            var y_range = viewport_range(relayout, 'yaxis', meta.height) || [0, meta.height];
+
+            var layout = Object.assign({}, figure.layout);
+            layout.xaxis = Object.assign({}, layout.xaxis, {'range': x_range, 'autorange': false});
+            layout.yaxis = Object.assign({}, layout.yaxis, {'range': y_range, 'autorange': false});
+            layout.images = (layout.images || []).slice(0, 1).concat(visible_tiles(meta, x_range, y_range, layout.width || 600));
+            return Object.assign({}, figure, {'layout': layout});
+        }
+    }
+});
+
+
+// at most this many tiles are shown at once, a coarser level is used otherwise
+var MAX_VIEW_TILES = 64;
+
+function viewport_range(relayout, axis, full) {
+    // the axis range a zoom / pan / reset reported, null if it did not touch the axis
+    if (relayout[axis + '.autorange']) {
+        return [0, full];
+    }
+    if (relayout[axis + '.range']) {
+        return relayout[axis + '.range'].slice(0, 2);
+    }
+    if ((axis + '.range[0]') in relayout) {
+        return [relayout[axis + '.range[0]'], relayout[axis + '.range[1]']];
+    }
+    return null;
+}
+
+function tile_span(low, high, step, count) {
+    // first and last index of the tiles of width `step` that [low, high] overlaps
+    var first = Math.max(0, Math.floor(low / step));
+    var last = Math.min(count - 1, Math.ceil(high / step) - 1);
+    return [first, last];
+}
+
+function visible_tiles(meta, x_range, y_range, screen_width) {
+    var x0 = Math.min(x_range[0], x_range[1]), x1 = Math.max(x_range[0], x_range[1]);
+    var y0 = Math.min(y_range[0], y_range[1]), y1 = Math.max(y_range[0], y_range[1]);
+    // result pixels per device pixel picks the level, 2 ** level of them per tile pixel
+    var density = (x1 - x0) / (screen_width * (window.devicePixelRatio || 1));
+    if (meta.width / meta.preview_width <= density) {
+        // the preview is already this sharp
+        return [];
+    }
+    var level = Math.max(0, Math.min(meta.levels - 1, Math.floor(Math.log2(Math.max(density, 1)))));
+
+    for (; level < meta.levels; level++) {
+        var scale = Math.pow(2, level);
+        var step = meta.tile_size * scale;
+        var cols = tile_span(x0, x1, step, Math.ceil(Math.ceil(meta.width / scale) / meta.tile_size));
+        // tile rows count down from the top, y counts up from the bottom
+        var rows = tile_span(meta.height - y1, meta.height - y0, step, Math.ceil(Math.ceil(meta.height / scale) / meta.tile_size));
+        if ((cols[1] - cols[0] + 1) * (rows[1] - rows[0] + 1) <= MAX_VIEW_TILES) {
+            break;
+        }
+    }
+    if (level >= meta.levels) {
+        return [];
+    }
+
+    var tiles = [];
+    for (var row = rows[0]; row <= rows[1]; row++) {
+        for (var col = cols[0]; col <= cols[1]; col++) {
+            var left = col * step, top = meta.height - row * step;
+            tiles.push({
+                'source': meta.tiles + '/' + level + '/' + row + '/' + col,
+                'xref': 'x', 'yref': 'y', 'x': left, 'y': top,
+                'sizex': Math.min(step, meta.width - left), 'sizey': Math.min(step, top),
+                'xanchor': 'left', 'yanchor': 'top', 'sizing': 'stretch', 'layer': 'above'
+            });
+        }
+    }
+    return tiles;
+}
+
+
+// the page keeps whichever image was uploaded last, by either route
+var current_source = null;
+
+function latest_source(contents, stream) {
+    var triggered = (window.dash_clientside.callback_context.triggered || []).map(function(trigger) {
+        return trigger.prop_id;
+    });
+    if ((triggered.indexOf('upload-image.contents') >= 0) && contents && contents.length) {
+        current_source = contents[0];
+    } else if ((triggered.indexOf('stream-handle.data') >= 0) && stream) {
+        current_source = stream.url;
+    } else if (!current_source) {
+        current_source = (contents && contents.length) ? contents[0] : (stream ? stream.url : null);
+    }
+    return current_source;
+}
+
+
+function pick_file() {
+    // resolves with the chosen file, or null when the dialog is dismissed
+    return new Promise(function(resolve) {
+        var input = document.createElement('input');
+        input.type = 'file';
+        input.accept = 'image/*';
+        input.addEventListener('change', function() {
+            resolve(input.files.length ? input.files[0] : null);
+        });
+        input.addEventListener('cancel', function() {
+            resolve(null);
+        });
+        input.click();
+    });
+}
+
+
+function send_file(file, chunk_bytes) {
+    var upload_id = random_id();
+    var offset = 0;
+
+    function send_chunk() {
+        show_status('Uploading ' + file.name + ' ... ' + Math.floor(100 * offset / file.size) + ' %');
+        if (offset >= file.size) {
+            return fetch('/upload/' + upload_id + '/finish', {'method': 'POST'}).then(read_reply);
+        }
+        var chunk = file.slice(offset, offset + chunk_bytes);
+        return fetch('/upload/' + upload_id + '?offset=' + offset, {'method': 'PUT', 'body': chunk})
+            .then(read_reply)
+            .then(function(reply) {
+                offset = reply.received;
+                return send_chunk();
+            });
+    }
+    return send_chunk();
+}
+
+
+function show_status(text) {
+    if (window.dash_clientside.set_props) {
+        window.dash_clientside.set_props('stream-status', {'children': text});
+    }
+}
+
+
+function random_id() {
+    var bytes = new Uint8Array(16);
+    window.crypto.getRandomValues(bytes);
+    return Array.prototype.map.call(bytes, function(value) {
+        return ('0' + value.toString(16)).slice(-2);
+    }).join('');
+}
+
+
+function read_reply(response) {
+    return response.json().then(function(reply) {
+        if (!response.ok) {
+            throw new Error(reply.error || response.statusText);
+        }
+        return reply;
+    });
+}
+
+
+function render_operation(image, operation, gray_scale, max_size) {
+    // same fit as image_transport.fit_preview, never upscaling
+    var scale = Math.min(1.0, max_size[0] / image.width, max_size[1] / image.height);
+    var width = Math.max(1, Math.round(image.width * scale));
+    var height = Math.max(1, Math.round(image.height * scale));
+
+    var canvas = document.createElement('canvas');
+    canvas.width = width;
+    canvas.height = height;
+    var context = canvas.getContext('2d');
+    context.imageSmoothingQuality = 'high';
+    context.translate((operation === 'mirror') ? width : 0, (operation === 'flip') ? height : 0);
+    context.scale((operation === 'mirror') ? -1 : 1, (operation === 'flip') ? -1 : 1);
+    context.drawImage(image, 0, 0, width, height);
+
+    if (gray_scale || (operation === 'invert')) {
+        var pixels = context.getImageData(0, 0, width, height);
+        var data = pixels.data;
+        for (var index = 0; index < data.length; index += 4) {
+            var red = data[index], green = data[index + 1], blue = data[index + 2];
+            if (gray_scale) {
+                // cv2.COLOR_BGR2GRAY fixed point weights, applied to the RGB
+                // upload the way ImageOperations.read_this does
+                red = green = blue = (red * 3735 + green * 19235 + blue * 9798 + 16384) >> 15;
+            }
+            if (operation === 'invert') {
+                red = 255 - red;
+                green = 255 - green;
+                blue = 255 - blue;
+            }
+            data[index] = red;
+            data[index + 1] = green;
+            data[index + 2] = blue;
+        }
+        context.putImageData(pixels, 0, 0);
+    }
+    return canvas.toDataURL('image/png');
+}
+
+
+function preview_figure(source) {
+    // mirrors image_transport.build_preview_figure and style_figure
+    return {
+        'data': [{'type': 'image', 'source': source}],
+        'layout': {
+            'width': 600,
+            'height': 400,
+            'margin': {'l': 0, 'r': 0, 'b': 0, 't': 0},
+            'coloraxis': {'showscale': false},
+            'xaxis': {'showticklabels': false},
+            'yaxis': {'showticklabels': false}
+        }
+    };
+}
@@ -0,0 +1,73 @@
+import time
+import uuid
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from image_ops_scratch import decode_image_string
+from tiled_exec import available_cpus
+
+
+class BatchRunner(object):
+    def __init__(self, workers=None, max_batches=16):
+        self.workers = workers or available_cpus()
+        self.max_batches = max_batches
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.batches = OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, contents, filenames, process):
+        # process(image) runs on a worker for every decoded upload and its
+        # return value is kept as the file's result.
+        batch_id = uuid.uuid4().hex
+        filenames = filenames or [None] * len(contents)
+        records = [
+            {'index' : index, 'filename' : filename, 'status' : 'pending'}
+            for index, filename in enumerate(filenames)
+        ]
+        with self.lock:
+            self.batches[batch_id] = {'records' : records, 'finished' : 0}
+            while len(self.batches) > self.max_batches:
+                self.batches.popitem(last=False)
+
+        for record, content in zip(records, contents):
+            self.pool.submit(self.run_one, batch_id=batch_id, record=record, content=content, process=process)
+        return batch_id
+
+    def run_one(self, batch_id, record, content, process):
+        start = time.perf_counter()
+        try:
+            image = decode_image_string(content=content)
+            decoded = time.perf_counter()
+            result = process(image)
+            record.update({
+                'status' : 'done',
+                'result' : result,
+                'shape' : image.shape,
+                'decode_ms' : (decoded - start) * 1000,
+                'process_ms' : (time.perf_counter() - decoded) * 1000,
+            })
+        except Exception as error:
+            record.update({'status' : 'error', 'error' : '{}: {}'.format(type(error).__name__, error)})
+        record['total_ms'] = (time.perf_counter() - start) * 1000
+
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is not None:
+                batch['finished'] += 1
+                record['order'] = batch['finished']
+        return record
+
+    def poll(self, batch_id):
+        # finished records in completion order, and whether the batch is done
+        with self.lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return [], True
+            finished = [record for record in batch['records'] if 'order' in record]
+            done = batch['finished'] == len(batch['records'])
+        return sorted(finished, key=lambda record: record['order']), done
+
+    def shutdown(self):
+        self.pool.shutdown()
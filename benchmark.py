@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from image_ops_scratch import ImageOperations
+from image_morphs_scratch import (MorphologicalTransformations, MORPH_ENGINES)
+from tiled_exec import TiledExecutor
+
+BENCH_IMAGES = ('lena_original.png', 'Finger-arch.jpg', 'scenary.jpg', 'pinktree.jpg')
+# synthetic inputs are this bundled image resized to the requested megapixels
+SYNTHETIC_BASE = 'scenary.jpg'
+
+OPERATIONS = (
+    'read_this', 'equalize_this', 'flip_this', 'mirror_this',
+    'binarize_this', 'invert_this', 'solarize_this'
+)
+TRANSFORMATIONS = (
+    'erode_image', 'dilate_image', 'open_image', 'close_image',
+    'morph_gradient', 'extract_boundary', 'get_tophat', 'get_blackhat'
+)
+
+
+def load_image(image_name, image_dir='images'):
+    image = cv2.imread(os.path.join(image_dir, image_name), 1)
+    if image is None:
+        raise ValueError('Could not read {}'.format(image_name))
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def synthetic_image(base, megapixels):
+    height, width = base.shape[:2]
+    scale = (megapixels * 1e6 / (height * width)) ** 0.5
+    size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(base, size, interpolation=cv2.INTER_LINEAR)
+
+
+def bench_inputs(image_names, sizes, image_dir='images'):
+    for image_name in image_names:
+        yield image_name, load_image(image_name=image_name, image_dir=image_dir)
+    base = load_image(image_name=SYNTHETIC_BASE, image_dir=image_dir)
+    for megapixels in sizes:
+        yield 'synthetic-{:g}mp'.format(megapixels), synthetic_image(base=base, megapixels=megapixels)
+
+
+def measure(func, repeat):
+    # timings come from plain runs; one extra run under tracemalloc gives
+    # the peak of numpy/OpenCV array allocations without slowing the timed
+    # runs down.
+    func()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return timings, peak_bytes
+
+
+def bench_cases(image, levels, engines, shapes=('square', ), executor=None):
+    # (method, mode, level, engine, func) for every benchmarked call; morph
+    # methods get their thresholded input prepared outside the timed call.
+    # Non-square shapes are reported as '<engine>-<shape>'.
+    for method in OPERATIONS:
+        for gray_scale in (False, True):
+            func = lambda method=method, gray_scale=gray_scale: getattr(
+                ImageOperations(image_file_src=image, executor=executor), method
+            )(gray_scale=gray_scale)
+            yield method, ('gray' if gray_scale else 'color'), None, None, func
+
+    image_src = MorphologicalTransformations(image_file_src=image, level=3).read_this()
+    yield 'threshold', 'gray', None, None, lambda: MorphologicalTransformations(
+        image_file_src=image, level=3
+    ).read_this()
+    for engine in engines:
+        for shape in shapes:
+            engine_name = engine if shape == 'square' else '{}-{}'.format(engine, shape)
+            for level in levels:
+                for method in TRANSFORMATIONS:
+                    func = lambda method=method, level=level, engine=engine, shape=shape: getattr(
+                        MorphologicalTransformations(
+                            image_file_src=image, level=level, engine=engine, executor=executor, shape=shape
+                        ), method
+                    )(image_src=image_src)
+                    yield method, 'gray', level, engine_name, func
+
+
+def run_benchmarks(
+    image_names, sizes, levels, engines, shapes=('square', ), repeat=3, only=None, executor=None, image_dir='images'
+):
+    results = []
+    for image_name, image in bench_inputs(image_names=image_names, sizes=sizes, image_dir=image_dir):
+        pixels = image.shape[0] * image.shape[1]
+        cases = bench_cases(image=image, levels=levels, engines=engines, shapes=shapes, executor=executor)
+        for method, mode, level, engine, func in cases:
+            case = '/'.join(str(part) for part in (image_name, method, mode, level, engine) if part is not None)
+            if only and not any(part in case for part in only):
+                continue
+            timings, peak_bytes = measure(func=func, repeat=repeat)
+            best = min(timings)
+            record = {
+                'case' : case,
+                'image' : image_name,
+                'shape' : list(image.shape),
+                'method' : method,
+                'mode' : mode,
+                'level' : level,
+                'engine' : engine,
+                'best_s' : best,
+                'median_s' : statistics.median(timings),
+                'pixels_per_s' : pixels / best if best > 0 else None,
+                'peak_bytes' : peak_bytes,
+            }
+            results.append(record)
+            print('{:<48} {:>9.2f} ms {:>9.1f} Mpx/s {:>9.1f} MiB'.format(
+                case, best * 1000, (record['pixels_per_s'] or 0) / 1e6, peak_bytes / 1024 ** 2
+            ))
+            sys.stdout.flush()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment_info(workers):
+    return {
+        'revision' : git_revision(),
+        'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python' : platform.python_version(),
+        'numpy' : np.__version__,
+        'opencv' : cv2.__version__,
+        'machine' : platform.machine(),
+        'cpus' : os.cpu_count(),
+        'workers' : workers,
+    }
+
+
+def compare_results(base_results, new_results, threshold=0.15):
+    # cases slower than the base by more than `threshold` (a fraction of
+    # the base time) are regressions; cases missing on either side are skipped.
+    base_cases = {record['case'] : record for record in base_results}
+    rows, regressions = [], []
+    for record in new_results:
+        base = base_cases.get(record['case'])
+        if base is None:
+            continue
+        ratio = record['best_s'] / max(base['best_s'], 1e-9)
+        rows.append((record['case'], base['best_s'], record['best_s'], ratio))
+        if ratio > (1 + threshold):
+            regressions.append(record['case'])
+    return rows, regressions
+
+
+def print_comparison(rows, regressions):
+    for case, base_s, new_s, ratio in rows:
+        flag = 'SLOWER' if case in regressions else ('faster' if ratio < 1 else '')
+        print('{:<48} {:>9.2f} -> {:>9.2f} ms {:>6.2f}x {}'.format(case, base_s * 1000, new_s * 1000, ratio, flag))
+    print('{} cases compared, {} regressions'.format(len(rows), len(regressions)))
+
+
+def parse_list(text, cast=str):
+    return [cast(part) for part in text.split(',') if part.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every image operation and transformation.')
+    parser.add_argument('--images', default=','.join(BENCH_IMAGES), help='bundled images to run on, comma separated')
+    parser.add_argument('--sizes', default='1,12,50', help='synthetic image sizes in megapixels, comma separated')
+    parser.add_argument('--levels', default='3,5,9,15', help='morph levels, comma separated')
+    parser.add_argument('--engines', default='vhgw', help='morph engines out of {}'.format(', '.join(MORPH_ENGINES)))
+    parser.add_argument('--shapes', default='square', help='structuring elements, e.g. square,cross,disk,line-45')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case, the best one is reported')
+    parser.add_argument('--workers', type=int, default=0, help='tile workers, 0 runs every case single threaded')
+    parser.add_argument('--only', default='', help='run only cases containing one of these substrings')
+    parser.add_argument('--out', default=None, help='write the results as JSON to this file')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--results', default=None, help='with --compare, JSON results to check instead of running')
+    parser.add_argument('--threshold', type=float, default=0.15, help='slowdown fraction reported as a regression')
+    parser.add_argument('--image-dir', default='images')
+    args = parser.parse_args(argv)
+
+    if args.results:
+        with open(args.results) as results_file:
+            results = json.load(results_file)['results']
+    else:
+        executor = TiledExecutor(workers=args.workers) if args.workers > 1 else None
+        results = run_benchmarks(
+            image_names=parse_list(args.images), sizes=parse_list(args.sizes, float),
+            levels=parse_list(args.levels, int), engines=parse_list(args.engines), shapes=parse_list(args.shapes),
+            repeat=args.repeat, only=parse_list(args.only), executor=executor, image_dir=args.image_dir
+        )
+        if executor is not None:
+            executor.shutdown()
+
+        report = {'environment' : environment_info(workers=args.workers), 'results' : results}
+        if args.out:
+            with open(args.out, 'w') as out_file:
+                json.dump(report, out_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as base_file:
+            base_report = json.load(base_file)
+        rows, regressions = compare_results(
+            base_results=base_report['results'], new_results=results, threshold=args.threshold
+        )
+        print_comparison(rows=rows, regressions=regressions)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,290 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+
+import cv2
+import numpy as np
+
+from pipeline import Pipeline
+from tiled_exec import TiledExecutor
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+VIDEO_CODECS = {'.mp4' : 'mp4v', '.avi' : 'MJPG', '.mkv' : 'MJPG', '.mov' : 'mp4v'}
+
+# queued items after the last frame, or carrying the reader's error
+END_OF_STREAM = object()
+
+
+class FrameRing(object):
+    # a fixed set of frame buffers that are handed out and given back, so
+    # at most `size` frames are ever in flight. A buffer is reallocated
+    # only when a frame of another shape comes along.
+    def __init__(self, size):
+        self.size = size
+        self.free = queue.Queue()
+        for _ in range(size):
+            self.free.put(None)
+
+    def acquire(self, shape, stop_event=None):
+        # blocks while every buffer is in use, which is what bounds the
+        # read-ahead; gives up with None once stop_event is set
+        while True:
+            try:
+                buffer = self.free.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if (stop_event is not None) and stop_event.is_set():
+                    return None
+        if (buffer is None) or (buffer.shape != tuple(shape)):
+            buffer = np.empty(shape=shape, dtype=np.uint8)
+        return buffer
+
+    def release(self, buffer):
+        self.free.put(buffer)
+
+
+def video_frames(path):
+    # BGR frames decoded into one reused buffer
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError('Could not open video - {}'.format(path))
+    frame = None
+    try:
+        while True:
+            ok, frame = capture.read(frame)
+            if not ok:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+
+def directory_frames(path):
+    # BGR frames of the images in `path`, in file name order
+    names = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+    for name in names:
+        frame = cv2.imread(os.path.join(path, name), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ValueError('Could not decode {} as an image'.format(name))
+        yield frame
+
+
+def source_frames(path):
+    return directory_frames(path=path) if os.path.isdir(path) else video_frames(path=path)
+
+
+def source_fps(path, default=25.0):
+    if os.path.isdir(path):
+        return default
+    capture = cv2.VideoCapture(path)
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    capture.release()
+    return fps if fps > 0 else default
+
+
+class VideoSink(object):
+    def __init__(self, path, fps):
+        self.path = path
+        self.fps = fps
+        self.writer = None
+        self.frame_bgr = None
+
+    def open(self, frame):
+        # the size and color of the first frame fix those of the video
+        codec = VIDEO_CODECS.get(os.path.splitext(self.path)[1].lower(), 'mp4v')
+        height, width = frame.shape[:2]
+        self.writer = cv2.VideoWriter(
+            self.path, cv2.VideoWriter_fourcc(*codec), self.fps, (width, height), frame.ndim == 3
+        )
+        if not self.writer.isOpened():
+            raise ValueError('Could not open video writer - {}'.format(self.path))
+
+    def write(self, frame):
+        if self.writer is None:
+            self.open(frame=frame)
+        if frame.ndim == 3:
+            self.frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=self.frame_bgr)
+            frame = self.frame_bgr
+        self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+
+
+class DirectorySink(object):
+    def __init__(self, path, extension='.png'):
+        self.path = path
+        self.extension = extension
+        self.count = 0
+        self.frame_bgr = None
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, frame):
+        if frame.ndim == 3:
+            self.frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR, dst=self.frame_bgr)
+            frame = self.frame_bgr
+        if not cv2.imwrite(os.path.join(self.path, 'frame_{:06d}{}'.format(self.count, self.extension)), frame):
+            raise ValueError('Could not write frame {} to {}'.format(self.count, self.path))
+        self.count += 1
+
+    def close(self):
+        return None
+
+
+def open_sink(path, fps):
+    # a path with a video extension gets a video, anything else a directory of images
+    if os.path.splitext(path)[1].lower() in VIDEO_CODECS:
+        return VideoSink(path=path, fps=fps)
+    return DirectorySink(path=path)
+
+
+class FrameStream(object):
+    # runs a Pipeline over every frame of a video or image directory. A
+    # reader thread decodes up to `read_ahead` frames ahead and a writer
+    # thread encodes up to `write_behind` results behind, each into a fixed
+    # ring of buffers, so memory stays constant however long the sequence.
+    def __init__(self, pipeline, read_ahead=4, write_behind=4):
+        self.pipeline = pipeline
+        self.read_ahead = read_ahead
+        self.write_behind = write_behind
+        self.stats = {'frames' : 0, 'seconds' : 0.0, 'fps' : 0.0, 'read_wait_s' : 0.0, 'write_wait_s' : 0.0}
+
+    def read_loop(self, path, ring, frames_queue, stop_event):
+        try:
+            for frame in source_frames(path=path):
+                # the RGB copy the operations expect goes straight into a ring buffer
+                buffer = ring.acquire(shape=frame.shape, stop_event=stop_event)
+                if buffer is None:
+                    return None
+                frames_queue.put(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=buffer))
+            frames_queue.put(END_OF_STREAM)
+        except Exception as error:
+            frames_queue.put((END_OF_STREAM, error))
+        return None
+
+    def frames(self, path):
+        # RGB frames, each valid until the next one is requested
+        ring = FrameRing(size=(self.read_ahead + 1))
+        frames_queue = queue.Queue()
+        stop_event = threading.Event()
+        reader = threading.Thread(
+            target=self.read_loop, args=(path, ring, frames_queue, stop_event), name='frame-reader', daemon=True
+        )
+        reader.start()
+        frame = None
+        try:
+            while True:
+                waited = time.perf_counter()
+                item = frames_queue.get()
+                self.stats['read_wait_s'] += time.perf_counter() - waited
+                if frame is not None:
+                    ring.release(frame)
+                if item is END_OF_STREAM:
+                    return None
+                if isinstance(item, tuple):
+                    raise item[1]
+                frame = item
+                yield frame
+        finally:
+            stop_event.set()
+            reader.join()
+
+    def process(self, path, ring=None):
+        # (index, result) per frame; the result buffer comes from `ring`
+        # when given (and belongs to the caller until released) and is
+        # reused for the next frame otherwise
+        start = time.perf_counter()
+        out = None
+        for index, frame in enumerate(self.frames(path=path)):
+            shape = self.pipeline.output_shape(shape=frame.shape)
+            if ring is not None:
+                # blocks while the writer is `write_behind` results behind
+                waited = time.perf_counter()
+                out = ring.acquire(shape=shape)
+                self.stats['write_wait_s'] += time.perf_counter() - waited
+            elif (out is None) or (out.shape != shape):
+                out = np.empty(shape=shape, dtype=np.uint8)
+            result = self.pipeline.run(image_file_src=frame, out=out)
+            self.update_stats(frames=(index + 1), start=start)
+            yield index, result
+
+    def update_stats(self, frames, start):
+        seconds = time.perf_counter() - start
+        self.stats.update({'frames' : frames, 'seconds' : seconds, 'fps' : frames / max(seconds, 1e-9)})
+
+    def write_loop(self, sink, ring, results_queue, errors):
+        while True:
+            result = results_queue.get()
+            if result is END_OF_STREAM:
+                return None
+            try:
+                if not errors:
+                    sink.write(frame=result)
+            except Exception as error:
+                errors.append(error)
+            ring.release(result)
+
+    def run(self, path, sink, progress=None, progress_every=25):
+        # writes every result to `sink` and returns the stats; progress(stats)
+        # is called every `progress_every` frames
+        ring = FrameRing(size=(self.write_behind + 1))
+        results_queue = queue.Queue()
+        errors = []
+        writer = threading.Thread(
+            target=self.write_loop, args=(sink, ring, results_queue, errors), name='frame-writer', daemon=True
+        )
+        writer.start()
+        try:
+            for index, result in self.process(path=path, ring=ring):
+                if errors:
+                    raise errors[0]
+                results_queue.put(result)
+                if (progress is not None) and ((index + 1) % progress_every == 0):
+                    progress(dict(self.stats))
+        finally:
+            results_queue.put(END_OF_STREAM)
+            waited = time.perf_counter()
+            writer.join()
+            self.stats['write_wait_s'] += time.perf_counter() - waited
+            sink.close()
+        if errors:
+            raise errors[0]
+        return dict(self.stats)
+
+
+def print_progress(stats):
+    print('{frames} frames, {fps:.1f} fps'.format(**stats))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply a pipeline to every frame of a video or image directory.')
+    parser.add_argument('source', help='video file or directory of images')
+    parser.add_argument('out', help='output video (.mp4, .avi, .mkv, .mov) or directory of PNG frames')
+    parser.add_argument('--steps', required=True, help="pipeline, e.g. 'equalize > binarize > open:5'")
+    parser.add_argument('--read-ahead', type=int, default=4, help='frames decoded ahead of processing')
+    parser.add_argument('--write-behind', type=int, default=4, help='results queued for encoding')
+    parser.add_argument('--workers', type=int, default=0, help='tile workers per frame, 0 runs single threaded')
+    parser.add_argument('--fps', type=float, default=None, help='output frame rate, the source one by default')
+    args = parser.parse_args(argv)
+
+    executor = TiledExecutor(workers=args.workers) if args.workers > 1 else None
+    stream = FrameStream(
+        pipeline=Pipeline.from_text(text=args.steps, executor=executor),
+        read_ahead=args.read_ahead, write_behind=args.write_behind
+    )
+    sink = open_sink(path=args.out, fps=(args.fps or source_fps(path=args.source)))
+    try:
+        stats = stream.run(path=args.source, sink=sink, progress=print_progress)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    print('{frames} frames in {seconds:.2f} s, {fps:.1f} fps (waited {read_wait_s:.2f} s on reading, {write_wait_s:.2f} s on writing)'.format(**stats))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,35 +1,124 @@
 import cv2
 import numpy as np
 import json
-from matplotlib import pyplot as plt
+
+from morph_engines import (erode_mask, dilate_mask, reduce_element)
+from packed_binary import PackedBinaryImage
+from result_cache import (make_key, image_digest)
+from structuring import StructuringElement
+from jobs import check_cancelled
+
+# 'loop' is the original per-window implementation, kept for verification.
+MORPH_ENGINES = ('vhgw', 'packed', 'loop')
+
+# every transformation as a node over primitive erode/dilate passes and
+# cheap differences; 'source' is the thresholded input image.
+MORPH_GRAPH = {
+    'erode' : ('erode', ('source', )),
+    'dilate' : ('dilate', ('source', )),
+    'open' : ('dilate', ('erode', )),
+    'close' : ('erode', ('dilate', )),
+    'gradient' : ('subtract', ('dilate', 'erode')),
+    'boundary' : ('subtract', ('source', 'erode')),
+    'tophat' : ('subtract', ('source', 'open')),
+    'blackhat' : ('subtract', ('close', 'source')),
+}
+
+
+def node_depth(node):
+    # number of chained erode/dilate passes behind a node
+    if node == 'source':
+        return 0
+    how, input_nodes = MORPH_GRAPH[node]
+    depth = max(node_depth(node=input_node) for input_node in input_nodes)
+    return depth if how == 'subtract' else depth + 1
+
+
+def node_dtype(node):
+    # binary results are 0/255, differences of them can go negative
+    return np.int16 if MORPH_GRAPH[node][0] == 'subtract' else np.uint8
+
+
+def transform_tile(image_tile, level, engine, names, shape='square'):
+    morph = MorphologicalTransformations(image_file_src=None, level=level, engine=engine, shape=shape)
+    results = morph.compute_transformations(image_src=image_tile, names=names)
+    return np.stack([results[name] for name in names], axis=-1)
 
 class MorphologicalTransformations(object):
-    def __init__(self, image_file_src, level):
+    def __init__(self, image_file_src, level, engine='vhgw', cache=None, executor=None, shape='square', ladder=None):
+        if engine not in MORPH_ENGINES:
+            raise ValueError('Unknown morph engine - {}'.format(engine))
         self.level = 3 if (level == None) or (level <= 3) else level
+        # a shape name (see structuring.STRUCTURING_SHAPES) sized by level,
+        # or a ready StructuringElement such as a custom footprint
+        if isinstance(shape, StructuringElement):
+            self.element = shape
+        else:
+            self.element = StructuringElement.from_name(name=shape, level=self.level)
+        self.element_passes = self.element.decompose()
         self.image_file_src = image_file_src
+        self.engine = engine
+        self.cache = cache
+        self.executor = executor
+        # a MorphLadder shared across requests, so sweeping the level of
+        # one image costs an incremental pass per step
+        self.ladder = ladder
+        self.node_results = {}
+        # the packed engine's masks of the same nodes, 1 bit per pixel
+        self.packed_results = {}
         self.MAX_PIXEL = 255
         self.MIN_PIXEL = 0
         self.MID_PIXEL = self.MAX_PIXEL // 2
-        self.kernel = np.full(shape=(self.level, self.level), fill_value=255)
+        self.kernel = np.where(self.element.footprint, 255, 0).astype(np.uint8)
     
     def read_this(self):
-        image_src = cv2.cvtColor(self.image_file_src, cv2.COLOR_RGB2GRAY)
-        image_src = np.where((image_src <= self.MID_PIXEL), self.MIN_PIXEL, self.MAX_PIXEL)
+        image_src = self.cached_result(
+            image_src=self.image_file_src, name='threshold', level=None, 
+            compute=lambda: self.threshold_this(image_src=self.image_file_src)
+        )
         return image_src
 
+    def threshold_this(self, image_src):
+        image_src = cv2.cvtColor(image_src, cv2.COLOR_RGB2GRAY)
+        return self.mask_image(mask=(image_src > self.MID_PIXEL))
+
+    def mask_image(self, mask):
+        return np.where(mask, np.uint8(self.MAX_PIXEL), np.uint8(self.MIN_PIXEL))
+
+    def cached_result(self, image_src, name, compute, level=-1):
+        if self.cache is None:
+            return compute()
+        key = make_key(
+            digest=self.cache.digest(image_src=image_src), 
+            name=name, gray_scale=True, level=(self.cache_level() if level == -1 else level)
+        )
+        return self.cache.get_or_compute(key=key, compute=compute)
+
+    def cache_level(self):
+        # square results keep their plain level keys
+        return self.level if self.element.name == 'square' else self.element.key()
+
+    def cache_key(self, image_src, name):
+        return make_key(digest=self.cache.digest(image_src=image_src), name=name, gray_scale=True, level=self.cache_level())
+
     def get_flat_submatrices(self, image_src, h_reduce, w_reduce):
+        window_h, window_w = self.element.footprint.shape
         image_shape = image_src.shape
         flat_submats = np.array([
-            image_src[i:(i + self.level), j:(j + self.level)]
+            image_src[i:(i + window_h), j:(j + window_w)][self.element.footprint]
             for i in range(image_shape[0] - h_reduce) for j in range(image_shape[1] - w_reduce)
         ])
         return flat_submats
+    
+    def pad_element(self, image_src):
+        (anchor_y, anchor_x), (window_h, window_w) = self.element.anchor, self.element.footprint.shape
+        pad_width = ((anchor_y, window_h - 1 - anchor_y), (anchor_x, window_w - 1 - anchor_x))
+        return np.pad(array=image_src, pad_width=pad_width, mode='constant')
         
-    def erode_image(self, image_src, with_plot=False):
+    def erode_loop(self, image_src):
         orig_shape = image_src.shape
-        pad_width = self.level - 2
         
-        image_pad = np.pad(array=image_src, pad_width=pad_width, mode='constant')
+        image_pad = self.pad_element(image_src=image_src)
         pimg_shape = image_pad.shape
         
         h_reduce, w_reduce = (pimg_shape[0] - orig_shape[0]), (pimg_shape[1] - orig_shape[1])
@@ -37,19 +126,14 @@ class MorphologicalTransformations(object):
             image_src=image_pad, h_reduce=h_reduce, w_reduce=w_reduce
         )
         
-        image_eroded = np.array([255 if (i == self.kernel).all() else 0 for i in flat_submats])
+        image_eroded = self.mask_image(mask=np.array([(i == self.MAX_PIXEL).all() for i in flat_submats], dtype=bool))
         image_eroded = image_eroded.reshape(orig_shape)
-        
-        if with_plot:
-            self.plot_it(orig_matrix=image_src, trans_matrix=image_eroded, head_text='Eroded - {}'.format(self.level))
-            return None
         return image_eroded
     
-    def dilate_image(self, image_src, with_plot=False):        
+    def dilate_loop(self, image_src):
         orig_shape = image_src.shape
-        pad_width = self.level - 2
         
-        image_pad = np.pad(array=image_src, pad_width=pad_width, mode='constant')
+        image_pad = self.pad_element(image_src=image_src)
         pimg_shape = image_pad.shape
         
         h_reduce, w_reduce = (pimg_shape[0] - orig_shape[0]), (pimg_shape[1] - orig_shape[1])
@@ -57,8 +141,183 @@ class MorphologicalTransformations(object):
             image_src=image_pad, h_reduce=h_reduce, w_reduce=w_reduce
         )
         
-        image_dilated = np.array([255 if (i == self.kernel).any() else 0 for i in flat_submats])
+        image_dilated = self.mask_image(mask=np.array([(i == self.MAX_PIXEL).any() for i in flat_submats], dtype=bool))
         image_dilated = image_dilated.reshape(orig_shape)
+        return image_dilated
+    
+    def apply_engine(self, image_src, how):
+        if self.engine == 'loop':
+            if how == 'erode':
+                return self.erode_loop(image_src=image_src)
+            return self.dilate_loop(image_src=image_src)
+        
+        if self.element.name == 'square':
+            # the window of the original implementation spans (level - 2)
+            # pixels before the anchor and 1 after it.
+            reduce_mask = erode_mask if how == 'erode' else dilate_mask
+            image_mask = reduce_mask(mask=(image_src == self.MAX_PIXEL), before=(self.level - 2), after=1)
+        else:
+            image_mask = reduce_element(
+                mask=(image_src == self.MAX_PIXEL), passes=self.element_passes, how=('and' if how == 'erode' else 'or')
+            )
+        return self.mask_image(mask=image_mask)
+    
+    def uses_packed(self):
+        # the bit-packed engine only has the square window
+        return (self.engine == 'packed') and (self.element.name == 'square')
+
+    def packed_input(self, node):
+        # a node read back from the cache is packed again on first use
+        if node not in self.packed_results:
+            self.packed_results[node] = PackedBinaryImage.from_array(image_src=self.node_results[node], max_pixel=self.MAX_PIXEL)
+        return self.packed_results[node]
+
+    def packed_node(self, node):
+        # erode/dilate results stay packed for the passes after them and are
+        # only unpacked (as uint8) when asked for; differences are signed
+        how, input_nodes = MORPH_GRAPH[node]
+        if how == 'subtract':
+            masks = [self.packed_input(node=input_node).to_mask() for input_node in input_nodes]
+            return np.subtract(masks[0], masks[1], dtype=np.int16) * np.int16(self.MAX_PIXEL)
+        if node not in self.packed_results:
+            self.packed_results[node] = getattr(self.packed_input(node=input_nodes[0]), how)(level=self.level)
+        return self.packed_results[node].to_array(max_pixel=self.MAX_PIXEL, min_pixel=self.MIN_PIXEL, dtype=np.uint8)
+
+    def compute_packed(self, image_src, names):
+        for node in self.plan_transformations(names=names):
+            if (node in self.node_results) or ((node in self.packed_results) and (node not in names)):
+                continue
+            check_cancelled()
+            if node not in names:
+                self.packed_node(node=node)
+                continue
+            self.node_results[node] = self.packed_node(node=node)
+            if self.cache is not None:
+                self.node_results[node] = self.cache.put(key=self.cache_key(image_src=image_src, name=node), value=self.node_results[node])
+        return None
+
+    def uses_ladder(self):
+        return (self.ladder is not None) and (self.engine == 'vhgw') and (self.element.name == 'square')
+
+    def ladder_digest(self, image_src):
+        return image_digest(image_src=image_src) if self.cache is None else self.cache.digest(image_src=image_src)
+
+    def ladder_node(self, image_src, how):
+        image_mask = self.ladder.reduce(
+            digest=self.ladder_digest(image_src=image_src), how=('and' if how == 'erode' else 'or'), 
+            level=self.level, mask=lambda: (image_src == self.MAX_PIXEL)
+        )
+        return self.mask_image(mask=image_mask)
+    
+    def plan_transformations(self, names):
+        planned = []
+        def visit(node):
+            if (node == 'source') or (node in planned):
+                return None
+            for input_node in MORPH_GRAPH[node][1]:
+                visit(node=input_node)
+            planned.append(node)
+        for name in names:
+            if name not in MORPH_GRAPH:
+                raise ValueError('Unknown transformation - {}'.format(name))
+            visit(node=name)
+        return planned
+    
+    def apply_node(self, how, inputs):
+        if how == 'subtract':
+            return np.subtract(inputs[0], inputs[1], dtype=np.int16)
+        return self.apply_engine(image_src=inputs[0], how=how)
+    
+    def compute_transformations(self, image_src, names=None):
+        names = list(MORPH_GRAPH) if names is None else names
+        # intermediate results are kept for the latest image only, so asking
+        # for several outputs runs each erode/dilate pass once.
+        if self.node_results.get('source') is not image_src:
+            self.node_results = {'source' : image_src}
+            self.packed_results = {}
+        
+        missing = self.cached_nodes(image_src=image_src, names=names)
+        if self.executor is not None:
+            self.compute_tiled(image_src=image_src, missing=missing)
+        
+        missing = [name for name in names if name not in self.node_results]
+        if self.uses_packed():
+            self.compute_packed(image_src=image_src, names=missing)
+            return {name : self.node_results[name] for name in names}
+        for node in self.plan_transformations(names=missing):
+            if node in self.node_results:
+                continue
+            check_cancelled()
+            how, input_nodes = MORPH_GRAPH[node]
+            inputs = [self.node_results[input_node] for input_node in input_nodes]
+            if (input_nodes == ('source', )) and self.uses_ladder():
+                compute = lambda how=how: self.ladder_node(image_src=image_src, how=how)
+            else:
+                compute = lambda how=how, inputs=inputs: self.apply_node(how=how, inputs=inputs)
+            self.node_results[node] = compute()
+            # only what was asked for is cached, intermediates would crowd it
+            if (node in missing) and (self.cache is not None):
+                self.node_results[node] = self.cache.put(key=self.cache_key(image_src=image_src, name=node), value=self.node_results[node])
+        return {name : self.node_results[name] for name in names}
+    
+    def cached_nodes(self, image_src, names):
+        # takes the requested results the cache already has, before any
+        # intermediate they depend on is computed; returns the rest
+        missing = []
+        for name in names:
+            if name in self.node_results:
+                continue
+            cached = None if self.cache is None else self.cache.get(key=self.cache_key(image_src=image_src, name=name))
+            if cached is None:
+                missing.append(name)
+            else:
+                self.node_results[name] = cached
+        return missing
+    
+    def compute_tiled(self, image_src, missing):
+        if self.uses_ladder():
+            # erode/dilate with a lower level on the ladder are one small
+            # pass away, cheaper than tiling them from scratch
+            digest = self.ladder_digest(image_src=image_src)
+            missing = [
+                name for name in missing if (MORPH_GRAPH[name][1] != ('source', )) or 
+                (self.ladder.nearest(digest=digest, how=('and' if name == 'erode' else 'or'), level=self.level) is None)
+            ]
+        
+        # each pass can reach as far as the element across a tile seam
+        halo = max([node_depth(node=name) for name in missing] + [0]) * self.element.reach()
+        if (not missing) or (not self.executor.is_tiled(shape=image_src.shape, halo=halo)):
+            return None
+        
+        image_tiled = self.executor.run(
+            func=transform_tile, image_src=image_src, halo=halo, 
+            args=(self.level, self.engine, missing, self.element)
+        )
+        for index, name in enumerate(missing):
+            result = np.ascontiguousarray(image_tiled[..., index], dtype=node_dtype(node=name))
+            if self.cache is not None:
+                result = self.cache.put(key=self.cache_key(image_src=image_src, name=name), value=result)
+            self.node_results[name] = result
+            if self.uses_ladder() and (MORPH_GRAPH[name][1] == ('source', )):
+                self.ladder.seed(
+                    digest=digest, how=('and' if name == 'erode' else 'or'), level=self.level, 
+                    mask=(image_src == self.MAX_PIXEL), result=(result == self.MAX_PIXEL)
+                )
+        return None
+    
+    def evaluate_node(self, image_src, node):
+        return self.compute_transformations(image_src=image_src, names=[node])[node]
+    
+    def erode_image(self, image_src, with_plot=False):
+        image_eroded = self.evaluate_node(image_src=image_src, node='erode')
+        
+        if with_plot:
+            self.plot_it(orig_matrix=image_src, trans_matrix=image_eroded, head_text='Eroded - {}'.format(self.level))
+            return None
+        return image_eroded
+    
+    def dilate_image(self, image_src, with_plot=False):
+        image_dilated = self.evaluate_node(image_src=image_src, node='dilate')
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_dilated, head_text='Dilated - {}'.format(self.level))
@@ -66,8 +325,7 @@ class MorphologicalTransformations(object):
         return image_dilated
     
     def open_image(self, image_src, with_plot=False):
-        image_eroded = self.erode_image(image_src=image_src)
-        image_opening = self.dilate_image(image_src=image_eroded)
+        image_opening = self.evaluate_node(image_src=image_src, node='open')
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_opening, head_text='Opening - {}'.format(self.level))
@@ -75,8 +333,7 @@ class MorphologicalTransformations(object):
         return image_opening
     
     def close_image(self, image_src, with_plot=False):
-        image_dilated = self.dilate_image(image_src=image_src)
-        image_closing = self.erode_image(image_src=image_dilated)
+        image_closing = self.evaluate_node(image_src=image_src, node='close')
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_closing, head_text='Closing - {}'.format(self.level))
@@ -84,9 +341,7 @@ class MorphologicalTransformations(object):
         return image_closing
     
     def morph_gradient(self, image_src, with_plot=False):
-        image_dilated = self.dilate_image(image_src=image_src)
-        image_eroded = self.erode_image(image_src=image_src)
-        image_grad = image_dilated - image_eroded
+        image_grad = self.evaluate_node(image_src=image_src, node='gradient')
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_grad, head_text='Gradient Morph - {}'.format(self.level))
@@ -94,8 +349,7 @@ class MorphologicalTransformations(object):
         return image_grad
     
     def extract_boundary(self, image_src, with_plot=False):
-        image_eroded = self.erode_image(image_src=image_src)
-        ext_bound = image_src - image_eroded
+        ext_bound = self.evaluate_node(image_src=image_src, node='boundary')
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=ext_bound, head_text='Boundary - {}'.format(self.level))
@@ -103,8 +357,7 @@ class MorphologicalTransformations(object):
         return ext_bound
     
     def get_tophat(self, image_src, with_plot=False):
-        image_opening = self.open_image(image_src=image_src)
-        image_tophat = image_src - image_opening
+        image_tophat = self.evaluate_node(image_src=image_src, node='tophat')
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_tophat, head_text='Top Hat - {}'.format(self.level))
@@ -112,8 +365,7 @@ class MorphologicalTransformations(object):
         return image_tophat
     
     def get_blackhat(self, image_src, with_plot=False):
-        image_closing = self.close_image(image_src=image_src)
-        image_blackhat = image_closing - image_src
+        image_blackhat = self.evaluate_node(image_src=image_src, node='blackhat')
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_blackhat, head_text='Black Hat - {}'.format(self.level))
@@ -121,6 +373,8 @@ class MorphologicalTransformations(object):
         return image_blackhat
     
     def plot_it(self, orig_matrix, trans_matrix, head_text):
+        from matplotlib import pyplot as plt
+        
         fig, (ax1, ax2) = plt.subplots(nrows=1, ncols=2, figsize=(10, 20))
         cmap_val = 'gray'
         
@@ -3,20 +3,48 @@ import numpy as np
 import json
 import base64
 
-from matplotlib import pyplot as plt
+from result_cache import make_key
 
 
-def read_image_string(contents):
-   encoded_data = contents[0].split(',')[1]
-   nparr = np.frombuffer(base64.b64decode(encoded_data), np.uint8)
+def decode_base64(content):
+   encoded_data = content.split(',')[1]
+   return np.frombuffer(base64.b64decode(encoded_data), np.uint8)
+
+
+def decode_image_bytes(nparr):
    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+   if img is None:
+       raise ValueError('Could not decode the uploaded file as an image')
    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
    return img
 
 
+def decode_image_string(content):
+   return decode_image_bytes(nparr=decode_base64(content=content))
+
+
+def read_image_string(contents):
+   return decode_image_string(content=contents[0])
+
+
+# intensity mappings that compile into a 256-entry lookup table
+POINTWISE_OPS = ('equalize', 'binarize', 'invert', 'solarize')
+
+
+def apply_lut(image_tile, lut, out=None):
+    # lut is (256, ) for gray images and (256, channels) for color ones
+    if (out is not None) and ((out.shape != image_tile.shape) or (out.dtype != np.uint8)):
+        raise ValueError('Output buffer must be uint8 with shape {}'.format(image_tile.shape))
+    if lut.ndim == 2:
+        lut = lut.reshape(1, 256, lut.shape[1])
+    return cv2.LUT(image_tile, lut, dst=out)
+
+
 class ImageOperations(object):
-    def __init__(self, image_file_src):
+    def __init__(self, image_file_src, cache=None, executor=None):
         self.image_file_src = image_file_src
+        self.cache = cache
+        self.executor = executor
         self.MAX_PIXEL = 255
         self.MIN_PIXEL = 0
         self.MID_PIXEL = self.MAX_PIXEL // 2
@@ -27,9 +55,89 @@ class ImageOperations(object):
             image_src = cv2.cvtColor(image_src, cv2.COLOR_BGR2GRAY)
         return image_src
     
+    def cached_result(self, name, compute, gray_scale=False, level=None):
+        if self.cache is None:
+            return compute()
+        key = make_key(
+            digest=self.cache.digest(image_src=self.image_file_src), 
+            name=name, gray_scale=gray_scale, level=level
+        )
+        return self.cache.get_or_compute(key=key, compute=compute)
+    
+    def equalize_lut(self, hist):
+        # same table cv2.equalizeHist builds, float32 maths and rounding included
+        lut = np.zeros(shape=256, dtype=np.uint8)
+        nonzero = np.flatnonzero(hist)
+        if not len(nonzero):
+            return lut
+        first = nonzero[0]
+        total = int(hist.sum())
+        if hist[first] == total:
+            lut[:] = first
+            return lut
+        scale = np.float32(self.MAX_PIXEL) / np.float32(total - hist[first])
+        cum_sum = np.cumsum(hist[(first + 1):]).astype(np.float32)
+        lut[(first + 1):] = np.clip(np.rint(cum_sum * scale), self.MIN_PIXEL, self.MAX_PIXEL)
+        return lut
+    
+    def channel_hist(self, image_matrix, channel):
+        hist = cv2.calcHist([image_matrix], [channel], None, [256], [0, 256]).ravel()
+        # float32 bins stop being exact counts past 2 ** 24 pixels
+        if hist.max() >= 2 ** 24:
+            n_channels = 1 if image_matrix.ndim == 2 else image_matrix.shape[2]
+            return np.bincount(image_matrix.reshape(-1, n_channels)[:, channel], minlength=256)
+        return hist.astype(np.int64)
+    
+    def step_lut(self, name, params, hist):
+        values = np.arange(256)
+        if name == 'invert':
+            return (self.MAX_PIXEL - values).astype(np.uint8)
+        if name == 'binarize':
+            thresh_val = params.get('thresh_val', self.MID_PIXEL)
+            return np.where((values <= thresh_val), self.MIN_PIXEL, self.MAX_PIXEL).astype(np.uint8)
+        if name == 'solarize':
+            thresh_val = params.get('thresh_val', 128)
+            return np.where((values < thresh_val), values, self.MAX_PIXEL - values).astype(np.uint8)
+        if name == 'equalize':
+            return self.equalize_lut(hist=hist)
+        raise ValueError('Unknown pointwise operation - {}'.format(name))
+    
+    def compile_lut(self, steps, image_matrix):
+        # steps are names or (name, params) pairs; the chain collapses into one
+        # table per channel and histograms for 'equalize' are pushed through
+        # the earlier steps instead of being re-measured on the image.
+        n_channels = 1 if image_matrix.ndim == 2 else image_matrix.shape[2]
+        luts = np.tile(np.arange(256, dtype=np.uint8)[:, None], (1, n_channels))
+        hists = None
+        for step in steps:
+            name, params = (step, {}) if isinstance(step, str) else step
+            for channel in range(n_channels):
+                hist = None
+                if name == 'equalize':
+                    if hists is None:
+                        hists = [self.channel_hist(image_matrix=image_matrix, channel=c) for c in range(n_channels)]
+                    hist = np.bincount(luts[:, channel], weights=hists[channel], minlength=256).astype(np.int64)
+                luts[:, channel] = self.step_lut(name=name, params=params, hist=hist)[luts[:, channel]]
+        return luts[:, 0] if n_channels == 1 else luts
+    
+    def run_pointwise(self, image_src, steps, out=None):
+        lut = self.compile_lut(steps=steps, image_matrix=image_src)
+        return self.run_lut(image_src=image_src, lut=lut, out=out)
+    
+    def run_lut(self, image_src, lut, out=None):
+        if (self.executor is None) or (not self.executor.is_tiled(shape=image_src.shape)):
+            return apply_lut(image_tile=image_src, lut=lut, out=out)
+        return self.executor.run(func=apply_lut, image_src=image_src, args=(lut, ), out=out)
+    
+    def apply_pointwise(self, steps, gray_scale=False, out=None):
+        image_src = self.read_this(gray_scale=gray_scale)
+        return self.run_pointwise(image_src=image_src, steps=steps, out=out)
+    
     def mirror_this(self, with_plot=False, gray_scale=False):
         image_src = self.read_this(gray_scale=gray_scale)
-        image_mirror = np.fliplr(image_src)
+        image_mirror = self.cached_result(
+            name='mirror', gray_scale=gray_scale, compute=lambda: np.fliplr(image_src)
+        )
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_mirror, head_text='Mirrored', gray_scale=gray_scale)
@@ -38,7 +146,9 @@ class ImageOperations(object):
     
     def flip_this(self, with_plot=False, gray_scale=False):
         image_src = self.read_this(gray_scale=gray_scale)
-        image_flip = np.flipud(image_src)
+        image_flip = self.cached_result(
+            name='flip', gray_scale=gray_scale, compute=lambda: np.flipud(image_src)
+        )
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_flip, head_text='Flipped', gray_scale=gray_scale)
@@ -47,18 +157,9 @@ class ImageOperations(object):
     
     def equalize_this(self, with_plot=False, gray_scale=False):
         image_src = self.read_this(gray_scale=gray_scale)
-        if not gray_scale:
-            r_image = image_src[:, :, 0]
-            g_image = image_src[:, :, 1]
-            b_image = image_src[:, :, 2]
-
-            r_image_eq = cv2.equalizeHist(r_image)
-            g_image_eq = cv2.equalizeHist(g_image)
-            b_image_eq = cv2.equalizeHist(b_image)
-
-            image_eq = np.dstack(tup=(r_image_eq, g_image_eq, b_image_eq))
-        else:
-            image_eq = cv2.equalizeHist(image_src)
+        image_eq = self.cached_result(
+            name='equalize', gray_scale=gray_scale, compute=lambda: self.run_pointwise(image_src=image_src, steps=['equalize'])
+        )
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_eq, head_text='Equalized', gray_scale=gray_scale)
@@ -74,7 +175,10 @@ class ImageOperations(object):
 
     def binarize_this(self, with_plot=False, gray_scale=False, colors=None):
         image_src = self.read_this(gray_scale=gray_scale)
-        image_b = self.convert_binary(image_matrix=image_src, thresh_val=self.MID_PIXEL)
+        image_b = self.cached_result(
+            name='binarize', gray_scale=gray_scale, 
+            compute=lambda: self.run_pointwise(image_src=image_src, steps=['binarize'])
+        )
 
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_b, head_text='Binarized', gray_scale=gray_scale)
@@ -83,7 +187,9 @@ class ImageOperations(object):
     
     def invert_this(self, with_plot=False, gray_scale=False):
         image_src = self.read_this(gray_scale=gray_scale)
-        image_i = ~ image_src
+        image_i = self.cached_result(
+            name='invert', gray_scale=gray_scale, compute=lambda: self.run_pointwise(image_src=image_src, steps=['invert'])
+        )
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_i, head_text='Inverted', gray_scale=gray_scale)
@@ -92,14 +198,12 @@ class ImageOperations(object):
 
     def solarize_this(self, thresh_val=128, with_plot=False, gray_scale=False):
         image_src = self.read_this(gray_scale=gray_scale)
-        if not gray_scale:
-            r_image, g_image, b_image = image_src[:, :, 0], image_src[:, :, 1], image_src[:, :, 2]
-            r_sol = np.where((r_image < thresh_val), r_image, ~r_image)
-            g_sol = np.where((g_image < thresh_val), g_image, ~g_image)
-            b_sol = np.where((b_image < thresh_val), b_image, ~b_image)
-            image_sol = np.dstack(tup=(r_sol, g_sol, b_sol))
-        else:
-            image_sol = np.where((image_src < thresh_val), image_src, ~image_src)
+        image_sol = self.cached_result(
+            name='solarize', gray_scale=gray_scale, level=thresh_val, 
+            compute=lambda: self.run_pointwise(
+                image_src=image_src, steps=[('solarize', {'thresh_val' : thresh_val})]
+            )
+        )
         
         if with_plot:
             self.plot_it(orig_matrix=image_src, trans_matrix=image_src, head_text='Solarized', gray_scale=gray_scale)
@@ -107,6 +211,9 @@ class ImageOperations(object):
         return image_sol
     
     def plot_it(self, orig_matrix, trans_matrix, head_text, gray_scale=False):
+        # imported here so the server never loads matplotlib
+        from matplotlib import pyplot as plt
+        
         fig, (ax1, ax2) = plt.subplots(nrows=1, ncols=2, figsize=(10, 20))
         cmap_val = None if not gray_scale else 'gray'
         
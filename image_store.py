@@ -0,0 +1,255 @@
+import os
+import re
+import time
+import uuid
+import hashlib
+import tempfile
+import threading
+
+import numpy as np
+
+HANDLE_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+VARIANT_PATTERN = re.compile(r'^[a-z0-9_]+$')
+COPY_CHUNK_BYTES = 1024 ** 2
+
+
+class UploadTooLarge(ValueError):
+    pass
+
+
+class StoreFull(ValueError):
+    pass
+
+
+def default_root():
+    # /dev/shm keeps the files in memory on Linux; elsewhere fall back to
+    # the temp directory, which the page cache serves just as well once warm
+    base = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(base, 'image_app')
+
+
+def content_digest(content):
+    # the handle of an upload, hashed from its data URL so that a repeated
+    # upload is recognised before any decoding
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def file_digest(path):
+    # the handle of a streamed upload, hashed from its raw bytes
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file_obj:
+        for chunk in iter(lambda: file_obj.read(COPY_CHUNK_BYTES), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def entry_handle(path):
+    # '<handle>-<variant>.npy' and its '.tmp' files, '<upload id>.part'
+    return os.path.basename(path).split('-')[0].split('.')[0]
+
+
+class SharedImageStore(object):
+    # decoded uploads as .npy files that every worker process can map
+    # read-only instead of decoding the upload again. Files are touched on
+    # every read; those unread for `ttl_seconds`, and the least recently
+    # read ones above `max_bytes`, are removed by whichever process sweeps.
+    # The budget never removes the latest image (so one larger than the
+    # whole budget still works) nor files still being written.
+    def __init__(self, root=None, max_bytes=(1024 ** 3), ttl_seconds=3600, sweep_seconds=30, grace_seconds=300, max_parts=8):
+        self.root = root or default_root()
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.sweep_seconds = sweep_seconds
+        self.grace_seconds = grace_seconds
+        # uploads streaming in at once, across all processes
+        self.max_parts = max_parts
+        os.makedirs(self.root, exist_ok=True)
+
+        self.last_sweep = 0.0
+        self.lock = threading.Lock()
+
+        # per process, like every other counter on /metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, handle, variant='full'):
+        # handles come back from the browser, so never build a path from
+        # anything but a digest
+        if (not isinstance(handle, str)) or (not HANDLE_PATTERN.match(handle)) or (not VARIANT_PATTERN.match(variant)):
+            raise ValueError('Invalid image handle - {!r}'.format(handle))
+        return os.path.join(self.root, '{}-{}.npy'.format(handle, variant))
+
+    def part_path(self, upload_id):
+        # the raw file of an upload that is still streaming in; upload ids
+        # are picked by the browser, so they are held to the handle format
+        if (not isinstance(upload_id, str)) or (not HANDLE_PATTERN.match(upload_id)):
+            raise ValueError('Invalid upload id - {!r}'.format(upload_id))
+        return os.path.join(self.root, '{}.part'.format(upload_id))
+
+    def open_parts(self, now):
+        # uploads that received a chunk within the grace period
+        return [
+            path for last_read, _, path in self.entries() 
+            if path.endswith('.part') and (last_read >= now - self.grace_seconds)
+        ]
+
+    def free_bytes(self, path):
+        # room left in the store for the upload at `path` to grow into
+        used = sum(size for _, size, entry_path in self.entries() if entry_path != path)
+        return self.max_bytes - used
+
+    def append_part(self, upload_id, offset, stream, max_bytes):
+        # copy one chunk of the request body to the end of the upload
+        # without holding more than COPY_CHUNK_BYTES of it in memory. The
+        # store's budget covers uploads in progress too, so a chunk that
+        # does not fit even after a sweep is refused with StoreFull.
+        path = self.part_path(upload_id=upload_id)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset not in (0, size):
+            raise ValueError('Chunk at offset {} does not follow the {} bytes received'.format(offset, size))
+        now = time.time()
+        if (not offset) and (path not in self.open_parts(now=now)) and (len(self.open_parts(now=now)) >= self.max_parts):
+            raise StoreFull('{} uploads are already in progress - try again later'.format(self.max_parts))
+        free = self.free_bytes(path=path)
+        if free < offset + COPY_CHUNK_BYTES:
+            self.sweep(force=True, keep=upload_id)
+            free = self.free_bytes(path=path)
+        with open(path, 'r+b' if offset else 'wb') as file_obj:
+            file_obj.seek(offset)
+            for chunk in iter(lambda: stream.read(COPY_CHUNK_BYTES), b''):
+                if file_obj.tell() + len(chunk) > max_bytes:
+                    file_obj.truncate(0)
+                    raise UploadTooLarge('Uploads are limited to {} MB'.format(max_bytes // 1024 ** 2))
+                if file_obj.tell() + len(chunk) > free:
+                    file_obj.truncate(0)
+                    raise StoreFull('The server is out of room for uploads - try again later')
+                file_obj.write(chunk)
+            return file_obj.tell()
+
+    def finished_part(self, upload_id):
+        path = self.part_path(upload_id=upload_id)
+        if (not os.path.exists(path)) or (os.path.getsize(path) == 0):
+            raise ValueError('Nothing was uploaded for {}'.format(upload_id))
+        return path
+
+    def map_part(self, upload_id):
+        # the raw bytes of a finished upload, for cv2.imdecode to read in place
+        return np.memmap(self.finished_part(upload_id=upload_id), dtype=np.uint8, mode='r')
+
+    def part_digest(self, upload_id):
+        return file_digest(path=self.finished_part(upload_id=upload_id))
+
+    def discard_part(self, upload_id):
+        # also called on failed requests, whose upload id may be invalid
+        try:
+            os.remove(self.part_path(upload_id=upload_id))
+        except (OSError, ValueError):
+            pass
+
+    def contains(self, handle, variant='full'):
+        return os.path.exists(self.path(handle=handle, variant=variant))
+
+    def load(self, path):
+        try:
+            image_src = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return image_src
+
+    def get(self, handle, variant='full'):
+        image_src = self.load(path=self.path(handle=handle, variant=variant))
+        with self.lock:
+            if image_src is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return image_src
+
+    def put(self, handle, image_src, variant='full'):
+        # written under a temporary name and renamed, so readers in other
+        # processes never map a half written file
+        path = self.path(handle=handle, variant=variant)
+        temp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as file_obj:
+                np.save(file_obj, np.ascontiguousarray(image_src))
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.sweep(keep=handle)
+        # hand back the mapped copy so the decoded one can be freed
+        image_mapped = self.load(path=path)
+        return image_src if image_mapped is None else image_mapped
+
+    def entries(self):
+        # (last read, bytes, path) of every file, the stale temporary and
+        # abandoned upload ones included
+        listed = []
+        for entry in os.scandir(self.root):
+            if not entry.name.endswith(('.npy', '.tmp', '.part')):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            listed.append((stat.st_mtime, stat.st_size, entry.path))
+        return listed
+
+    def sweep(self, force=False, keep=None):
+        # `keep` is the handle just written, which the budget never removes
+        now = time.time()
+        with self.lock:
+            if (not force) and (now - self.last_sweep < self.sweep_seconds):
+                return 0
+            self.last_sweep = now
+
+        removed = 0
+        listed = sorted(self.entries())
+        total = sum(size for _, size, _ in listed)
+        images = [path for _, _, path in listed if path.endswith('.npy')]
+        kept = {keep, entry_handle(path=images[-1]) if images else None}
+        for last_read, size, path in listed:
+            if total <= self.max_bytes:
+                if last_read >= now - self.ttl_seconds:
+                    break
+            elif last_read >= now - self.ttl_seconds:
+                # only over the budget, so spare the latest image and
+                # whatever another process is still writing
+                if entry_handle(path=path) in kept:
+                    continue
+                if path.endswith(('.tmp', '.part')) and (last_read >= now - self.grace_seconds):
+                    continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        with self.lock:
+            self.evictions += removed
+        return removed
+
+    def clear(self):
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self):
+        listed = self.entries()
+        with self.lock:
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'entries' : len(listed),
+                'bytes' : sum(size for _, size, _ in listed),
+            }
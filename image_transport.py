@@ -0,0 +1,173 @@
+import uuid
+import base64
+import threading
+
+import cv2
+import numpy as np
+import plotly.io as pio
+import plotly.graph_objects as go
+
+from collections import OrderedDict
+
+PREVIEW_SIZE = (600, 400)
+IMAGE_FORMATS = {'png' : ('.png', 'image/png'), 'webp' : ('.webp', 'image/webp')}
+
+
+def display_range(image_src):
+    # the (low, high) a 2D result is stretched over, None for color ones
+    if image_src.ndim != 2:
+        return None
+    return int(image_src.min()), int(image_src.max())
+
+
+def to_display(image_src, value_range=None):
+    # 2D results were drawn as a gray heatmap stretched over their own range,
+    # so apply that stretch here and ship plain uint8 pixels. A part of a
+    # result is stretched over the `value_range` of the whole.
+    if image_src.ndim == 2:
+        low, high = display_range(image_src=image_src) if value_range is None else value_range
+        if (image_src.dtype == np.uint8) and (low == 0) and (high == 255):
+            return image_src
+        scale = 255.0 / max(high - low, 1)
+        return np.rint((image_src - low) * scale).astype(np.uint8)
+    if image_src.dtype != np.uint8:
+        return np.clip(image_src, 0, 255).astype(np.uint8)
+    return image_src
+
+
+def fit_preview(image_src, max_size=PREVIEW_SIZE):
+    height, width = image_src.shape[:2]
+    scale = min(1.0, max_size[0] / width, max_size[1] / height)
+    if scale >= 1.0:
+        return image_src
+    preview_size = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    return cv2.resize(image_src, preview_size, interpolation=cv2.INTER_AREA)
+
+
+def encode_image(image_src, fmt='png', quality=90):
+    extension, _ = IMAGE_FORMATS[fmt]
+    if image_src.dtype != np.uint8:
+        image_src = to_display(image_src=image_src)
+    if image_src.ndim == 3:
+        image_src = cv2.cvtColor(image_src, cv2.COLOR_RGB2BGR)
+    params = [cv2.IMWRITE_WEBP_QUALITY, quality] if fmt == 'webp' else [cv2.IMWRITE_PNG_COMPRESSION, 3]
+    ok, buffer = cv2.imencode(extension, image_src, params)
+    if not ok:
+        raise ValueError('Could not encode the image as {}'.format(fmt))
+    return buffer.tobytes()
+
+
+def encode_uri(image_src, fmt='png', quality=90):
+    _, mimetype = IMAGE_FORMATS[fmt]
+    encoded = base64.b64encode(encode_image(image_src=image_src, fmt=fmt, quality=quality)).decode()
+    return 'data:{};base64,{}'.format(mimetype, encoded)
+
+
+def encode_thumbnail(image, max_side=200):
+    return encode_uri(image_src=fit_preview(image_src=to_display(image_src=image), max_size=(max_side, max_side)))
+
+
+def style_figure(fig):
+    fig.update_layout(
+        coloraxis_showscale=False,
+        width=600, height=400,
+        margin=dict(l=0, r=0, b=0, t=0)
+    )
+    fig.update_xaxes(showticklabels=False)
+    fig.update_yaxes(showticklabels=False)
+    return fig
+
+
+def build_preview_figure(image_src, max_size=PREVIEW_SIZE, fmt='png'):
+    preview = fit_preview(image_src=to_display(image_src=image_src), max_size=max_size)
+    fig = go.Figure(go.Image(source=encode_uri(image_src=preview, fmt=fmt)))
+    return style_figure(fig=fig)
+
+
+def build_tiled_figure(image_src, tiles_url, pyramid_info, max_size=PREVIEW_SIZE, fmt='png'):
+    # the preview stretched over the result's full resolution coordinates,
+    # with y pointing up as layout images need. layout.meta tells the
+    # browser (assets/clientside.js) where to fetch sharper tiles from as
+    # the user zooms in.
+    height, width = image_src.shape[:2]
+    preview = fit_preview(image_src=to_display(image_src=image_src), max_size=max_size)
+    fig = go.Figure(go.Scatter(
+        x=[0, width], y=[0, height], mode='markers', marker_opacity=0, hoverinfo='skip', showlegend=False
+    ))
+    fig.add_layout_image(
+        source=encode_uri(image_src=preview, fmt=fmt), xref='x', yref='y', x=0, y=height, 
+        sizex=width, sizey=height, xanchor='left', yanchor='top', sizing='stretch', layer='below'
+    )
+    fig.update_xaxes(range=[0, width], showgrid=False, zeroline=False)
+    fig.update_yaxes(range=[0, height], showgrid=False, zeroline=False, scaleanchor='x')
+    fig.update_layout(
+        plot_bgcolor='rgba(0, 0, 0, 0)', uirevision=tiles_url,
+        meta=dict(pyramid_info, tiles=tiles_url, preview_width=preview.shape[1])
+    )
+    return style_figure(fig=fig)
+
+
+def build_empty_figure():
+    return style_figure(fig=go.Figure())
+
+
+def build_full_figure(image_src, gray_scale=False):
+    # the figure the app used to send; plotly.express is imported here as
+    # only measure_payload still builds it
+    import plotly.express as px
+    
+    fig = px.imshow(image_src, color_continuous_scale='gray') if gray_scale else px.imshow(image_src)
+    return style_figure(fig=fig)
+
+
+def measure_payload(image_src, gray_scale=False, fmt='png'):
+    full_bytes = len(pio.to_json(build_full_figure(image_src=image_src, gray_scale=gray_scale)))
+    preview_bytes = len(pio.to_json(build_preview_figure(image_src=image_src, fmt=fmt)))
+    return {'full_bytes' : full_bytes, 'preview_bytes' : preview_bytes, 'ratio' : full_bytes / max(preview_bytes, 1)}
+
+
+class ResultStore(object):
+    # full-resolution results kept server side so the browser only gets a
+    # preview plus a download link.
+    def __init__(self, max_bytes=(512 * 1024 ** 2)):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, image_src):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.entries[token] = image_src
+            self.n_bytes += image_src.nbytes
+            while (self.n_bytes > self.max_bytes) and (len(self.entries) > 1):
+                _, old_image = self.entries.popitem(last=False)
+                self.n_bytes -= old_image.nbytes
+        return token
+
+    def get(self, token):
+        with self.lock:
+            image_src = self.entries.get(token)
+            if image_src is not None:
+                self.entries.move_to_end(token)
+            return image_src
+
+
+if __name__ == '__main__':
+    from image_ops_scratch import ImageOperations
+    from image_morphs_scratch import MorphologicalTransformations
+
+    for image_name in ['lena_original.png', 'Finger-arch.jpg', 'scenary.jpg', 'pinktree.jpg']:
+        image = cv2.imread('images/{}'.format(image_name), 1)
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        morph = MorphologicalTransformations(image_file_src=image, level=3)
+        results = {
+            'color' : (ImageOperations(image_file_src=image).equalize_this(), False),
+            'gray' : (ImageOperations(image_file_src=image).equalize_this(gray_scale=True), True),
+            'morph' : (morph.morph_gradient(image_src=morph.read_this()), True),
+        }
+        for result_name, (result, gray_scale) in results.items():
+            sizes = measure_payload(image_src=result, gray_scale=gray_scale)
+            print('{:<18} {:<6} {:>12,} -> {:>9,} bytes ({:.1f}x smaller)'.format(
+                image_name, result_name, sizes['full_bytes'], sizes['preview_bytes'], sizes['ratio']
+            ))
@@ -0,0 +1,153 @@
+import time
+import uuid
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_STATES = ('queued', 'running', 'done', 'cancelled', 'error')
+
+# the cancel event of the job running on the current worker thread
+current_job = threading.local()
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def check_cancelled():
+    # long computations call this between steps (planner nodes, tiles,
+    # pipeline stages); it raises only inside a job that was cancelled.
+    cancel_event = getattr(current_job, 'cancel_event', None)
+    if (cancel_event is not None) and cancel_event.is_set():
+        raise JobCancelled()
+
+
+class JobQueue(object):
+    # finished results wait here until they are polled; those not polled
+    # within `result_ttl_seconds`, and the oldest ones above
+    # `max_result_bytes`, are dropped and poll as expired.
+    def __init__(self, workers=2, max_jobs=64, max_result_bytes=(512 * 1024 ** 2), result_ttl_seconds=600):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.max_result_bytes = max_result_bytes
+        self.result_ttl_seconds = result_ttl_seconds
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.jobs = OrderedDict()
+        self.result_bytes = 0
+        # session -> id of its latest job, which supersedes the earlier ones
+        self.latest = {}
+        self.lock = threading.Lock()
+
+    def submit(self, func, session=None, args=(), kwargs=None):
+        job_id = uuid.uuid4().hex
+        job = {
+            'id' : job_id,
+            'session' : session,
+            'status' : 'queued',
+            'cancel_event' : threading.Event(),
+            'submitted' : time.perf_counter(),
+        }
+        with self.lock:
+            if session is not None:
+                previous = self.jobs.get(self.latest.get(session))
+                if previous is not None:
+                    previous['cancel_event'].set()
+                self.latest[session] = job_id
+            self.jobs[job_id] = job
+            while len(self.jobs) > self.max_jobs:
+                self.drop(job_id=next(iter(self.jobs)))
+            self.sweep_results()
+
+        self.pool.submit(self.run_job, job=job, func=func, args=args, kwargs=(kwargs or {}))
+        return job_id
+
+    def run_job(self, job, func, args, kwargs):
+        if job['cancel_event'].is_set():
+            job.update({'status' : 'cancelled', 'finished' : time.perf_counter()})
+            return None
+        job.update({'status' : 'running', 'started' : time.perf_counter()})
+        current_job.cancel_event = job['cancel_event']
+        try:
+            result = func(*args, **kwargs)
+            # a result that was superseded while computing is thrown away
+            check_cancelled()
+            self.store_result(job=job, result=result)
+        except JobCancelled:
+            job['status'] = 'cancelled'
+        except Exception as error:
+            job.update({'status' : 'error', 'error' : '{}: {}'.format(type(error).__name__, error)})
+        finally:
+            current_job.cancel_event = None
+            job.setdefault('finished', time.perf_counter())
+        return None
+
+    def store_result(self, job, result):
+        with self.lock:
+            job.update({'status' : 'done', 'result' : result, 'finished' : time.perf_counter()})
+            if self.jobs.get(job['id']) is not job:
+                # evicted while it ran
+                job.pop('result')
+                return None
+            job['result_bytes'] = getattr(result, 'nbytes', 0)
+            self.result_bytes += job['result_bytes']
+            self.sweep_results(keep=job['id'])
+        return None
+
+    def drop(self, job_id):
+        # called with the lock held
+        job = self.jobs.pop(job_id, None)
+        if job is None:
+            return None
+        job['cancel_event'].set()
+        self.result_bytes -= job.get('result_bytes', 0)
+        if self.latest.get(job['session']) == job_id:
+            del self.latest[job['session']]
+        return job
+
+    def sweep_results(self, keep=None):
+        # called with the lock held; the result just stored is always kept
+        expired = time.perf_counter() - self.result_ttl_seconds
+        with_results = [job_id for job_id, job in self.jobs.items() if ('result' in job) and (job_id != keep)]
+        for job_id in with_results:
+            if (self.jobs[job_id]['finished'] < expired) or (self.result_bytes > self.max_result_bytes):
+                self.drop(job_id=job_id)
+        return None
+
+    def cancel_session(self, session):
+        # called as soon as a newer request of the session comes in, even
+        # one that will not need a job of its own
+        with self.lock:
+            job = self.jobs.get(self.latest.get(session))
+        if job is not None:
+            job['cancel_event'].set()
+        return job is not None
+
+    def cancel(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            job['cancel_event'].set()
+        return job is not None
+
+    def poll(self, job_id):
+        # a snapshot of the job, or None once it is forgotten or evicted
+        with self.lock:
+            self.sweep_results()
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        snapshot = {key : value for key, value in job.items() if key != 'cancel_event'}
+        snapshot['elapsed'] = job.get('finished', time.perf_counter()) - job['submitted']
+        return snapshot
+
+    def forget(self, job_id):
+        # drop a finished job and the result it holds
+        with self.lock:
+            return self.drop(job_id=job_id)
+
+    def shutdown(self):
+        with self.lock:
+            for job in self.jobs.values():
+                job['cancel_event'].set()
+        self.pool.shutdown()
@@ -0,0 +1,288 @@
+import io
+import json
+import time
+import random
+import pstats
+import cProfile
+import logging
+import threading
+
+from bisect import bisect_left
+
+# seconds, tuned for requests that run from a few milliseconds to tens of seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MEGAPIXEL_BUCKETS = (0.25, 1, 2, 4, 8, 12, 16, 25, 50, 100)
+BYTE_BUCKETS = (1e3, 1e4, 1e5, 3e5, 1e6, 3e6, 1e7, 3e7, 1e8)
+
+slow_logger = logging.getLogger('image_app.slow')
+
+
+def format_labels(label_names, label_values):
+    if not label_names:
+        return ''
+    pairs = []
+    for name, value in zip(label_names, label_values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} counter'.format(self.name)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, format_labels(self.label_names, key), format_value(value)))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'), )
+        # label values -> [per bucket counts, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.label_names)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text), '# TYPE {} histogram'.format(self.name)]
+        label_names = self.label_names + ('le', )
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, format_labels(label_names, key + (format_value(bound), )), cumulative
+                    ))
+                labels = format_labels(self.label_names, key)
+                lines.append('{}_sum{} {}'.format(self.name, labels, repr(total)))
+                lines.append('{}_count{} {}'.format(self.name, labels, count))
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+        # collectors return (name, type, help text, value) for values kept
+        # elsewhere, e.g. the result cache counters
+        self.collectors = []
+
+    def counter(self, name, help_text, label_names=()):
+        metric = Counter(name=name, help_text=help_text, label_names=label_names)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name=name, help_text=help_text, label_names=label_names, buckets=buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        self.collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            for name, metric_type, help_text, value in collect():
+                lines.append('# HELP {} {}'.format(name, help_text))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                lines.append('{} {}'.format(name, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class RequestTrace(object):
+    # timings of one callback run, split into named stages
+    def __init__(self, recorder, callback, info):
+        self.recorder = recorder
+        self.callback = callback
+        self.info = info
+        self.stages = []
+        self.shape = None
+        self.response_bytes = None
+        self.profiler = None
+        self.start = None
+        self.end = None
+        # set when something else (e.g. a Flask after_request hook) adds
+        # the remaining stages and calls finish()
+        self.deferred = False
+
+    def __enter__(self):
+        self.profiler = self.recorder.start_profiler()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.recorder.profile_lock.release()
+        if exc_type is not None:
+            self.info['error'] = exc_type.__name__
+        if not self.deferred:
+            self.finish()
+        return False
+
+    def stage(self, name):
+        return TraceStage(trace=self, name=name)
+
+    def add_stage(self, name, seconds):
+        self.stages.append((name, seconds))
+
+    def set_shape(self, shape):
+        self.shape = tuple(shape)
+
+    def total(self):
+        return sum(seconds for _, seconds in self.stages) + self.overhead()
+
+    def overhead(self):
+        # time inside the traced block that no stage accounted for
+        staged = sum(seconds for name, seconds in self.stages if name != 'serialize')
+        return max((self.end - self.start) - staged, 0.0)
+
+    def finish(self, response_bytes=None, **extra_stages):
+        self.response_bytes = response_bytes
+        for name, seconds in extra_stages.items():
+            self.add_stage(name=name, seconds=seconds)
+        self.recorder.record(trace=self)
+
+
+class TraceStage(object):
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.trace.add_stage(name=self.name, seconds=(time.perf_counter() - self.start))
+        return False
+
+
+class RequestMetrics(object):
+    LABELS = ('callback', 'operation', 'mode', 'level')
+
+    def __init__(self, slow_seconds=None, profile_rate=0.1, profile_lines=30, registry=None):
+        # requests slower than `slow_seconds` are logged with their stages;
+        # a `profile_rate` fraction of requests run under cProfile so that
+        # slow ones among them also carry a profile.
+        self.slow_seconds = slow_seconds
+        self.profile_rate = profile_rate if slow_seconds else 0.0
+        self.profile_lines = profile_lines
+        self.profile_lock = threading.Lock()
+        self.registry = registry or MetricsRegistry()
+        self.stage_seconds = self.registry.histogram(
+            'image_app_stage_seconds', 'Time spent per stage of a callback.', label_names=self.LABELS + ('stage', )
+        )
+        self.request_seconds = self.registry.histogram(
+            'image_app_request_seconds', 'Total time of a callback including serialization.', label_names=self.LABELS
+        )
+        self.input_megapixels = self.registry.histogram(
+            'image_app_input_megapixels', 'Size of the processed images.',
+            label_names=('callback', ), buckets=MEGAPIXEL_BUCKETS
+        )
+        self.response_bytes = self.registry.histogram(
+            'image_app_response_bytes', 'Size of the serialized callback response.',
+            label_names=('callback', ), buckets=BYTE_BUCKETS
+        )
+        self.slow_requests = self.registry.counter(
+            'image_app_slow_requests_total', 'Callbacks slower than the slow request threshold.',
+            label_names=('callback', )
+        )
+        self.errors = self.registry.counter(
+            'image_app_callback_errors_total', 'Callbacks that raised an exception.', label_names=('callback', 'error')
+        )
+
+    def trace(self, callback, **info):
+        return RequestTrace(recorder=self, callback=callback, info=info)
+
+    def start_profiler(self):
+        # only one request is profiled at a time
+        if (not self.profile_rate) or (random.random() >= self.profile_rate):
+            return None
+        if not self.profile_lock.acquire(blocking=False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            self.profile_lock.release()
+            return None
+        return profiler
+
+    def labels(self, trace):
+        level = trace.info.get('level')
+        return {
+            'callback' : trace.callback,
+            'operation' : trace.info.get('operation', ''),
+            'mode' : trace.info.get('mode', ''),
+            'level' : '' if level is None else level,
+        }
+
+    def record(self, trace):
+        labels = self.labels(trace=trace)
+        for name, seconds in trace.stages:
+            self.stage_seconds.observe(seconds, stage=name, **labels)
+        self.stage_seconds.observe(trace.overhead(), stage='other', **labels)
+        total = trace.total()
+        self.request_seconds.observe(total, **labels)
+        if trace.shape is not None:
+            self.input_megapixels.observe(trace.shape[0] * trace.shape[1] / 1e6, callback=trace.callback)
+        if trace.response_bytes is not None:
+            self.response_bytes.observe(trace.response_bytes, callback=trace.callback)
+        if 'error' in trace.info:
+            self.errors.inc(callback=trace.callback, error=trace.info['error'])
+        if self.slow_seconds and (total >= self.slow_seconds):
+            self.slow_requests.inc(callback=trace.callback)
+            self.log_slow(trace=trace, total=total)
+
+    def log_slow(self, trace, total):
+        entry = {
+            'callback' : trace.callback,
+            'total_ms' : round(total * 1000, 2),
+            'shape' : trace.shape,
+            'info' : trace.info,
+            'stages_ms' : {name : round(seconds * 1000, 2) for name, seconds in trace.stages},
+        }
+        message = 'slow request {}'.format(json.dumps(entry, default=str))
+        if trace.profiler is not None:
+            stream = io.StringIO()
+            pstats.Stats(trace.profiler, stream=stream).sort_stats('cumulative').print_stats(self.profile_lines)
+            message = '{}\n{}'.format(message, stream.getvalue())
+        slow_logger.warning(message)
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+def running_extreme(image_src, size, axis, how):
+    # van Herk / Gil-Werman: block-wise prefix and suffix scans give the
+    # reduction over every window of `size` with a constant cost per pixel.
+    ufunc = np.logical_and if how == 'and' else np.logical_or
+    identity = (how == 'and')
+
+    image_src = np.moveaxis(image_src, axis, -1)
+    length = image_src.shape[-1]
+    out_len = length - size + 1
+    n_blocks = -(-length // size)
+
+    padded = np.full(shape=image_src.shape[:-1] + (n_blocks * size, ), fill_value=identity, dtype=bool)
+    padded[..., :length] = image_src
+    blocks = padded.reshape(image_src.shape[:-1] + (n_blocks, size))
+
+    prefix = ufunc.accumulate(blocks, axis=-1).reshape(padded.shape)
+    suffix = ufunc.accumulate(blocks[..., ::-1], axis=-1)[..., ::-1].reshape(padded.shape)
+
+    window_ext = ufunc(suffix[..., :out_len], prefix[..., (size - 1):(size - 1 + out_len)])
+    return np.moveaxis(window_ext, -1, axis)
+
+
+def reduce_window(mask, before, after, how):
+    # window of pixel (i, j) spans rows i - before .. i + after and the same
+    # columns; anything outside the image counts as background.
+    size = before + after + 1
+    if size == 1:
+        return mask.copy()
+    mask_pad = np.pad(array=mask, pad_width=((before, after), (before, after)), mode='constant')
+    rows_ext = running_extreme(image_src=mask_pad, size=size, axis=0, how=how)
+    return running_extreme(image_src=rows_ext, size=size, axis=1, how=how)
+
+
+def erode_mask(mask, before, after):
+    return reduce_window(mask=mask, before=before, after=after, how='and')
+
+
+def dilate_mask(mask, before, after):
+    return reduce_window(mask=mask, before=before, after=after, how='or')
+
+
+def reduce_span(mask, first, last, axis, how):
+    # pixel i reduces over i + first .. i + last along `axis`; the span
+    # does not have to contain i itself.
+    reach = max(abs(first), abs(last))
+    pad_width = [(0, 0)] * mask.ndim
+    pad_width[axis] = (reach, reach)
+    mask_pad = np.pad(array=mask, pad_width=pad_width, mode='constant')
+    span_ext = running_extreme(image_src=mask_pad, size=(last - first + 1), axis=axis, how=how)
+    return np.take(span_ext, indices=np.arange(mask.shape[axis]) + reach + first, axis=axis)
+
+
+def reduce_rect(mask, rows, cols, how):
+    # rows and cols are (first, last) offsets of the rectangle from the pixel
+    rows_ext = reduce_span(mask=mask, first=rows[0], last=rows[1], axis=0, how=how)
+    return reduce_span(mask=rows_ext, first=cols[0], last=cols[1], axis=1, how=how)
+
+
+def reduce_diagonal(mask, first, last, direction, how):
+    # pixel (i, j) reduces over (i + k, j + direction * k) for k in
+    # first .. last; shearing the image turns those diagonals into columns.
+    height, width = mask.shape
+    rows = np.arange(height)[:, None]
+    cols = np.arange(width)[None, :] - direction * rows + (height - 1 if direction == 1 else 0)
+    sheared = np.zeros(shape=(height, width + height - 1), dtype=bool)
+    sheared[rows, cols] = mask
+    sheared = reduce_span(mask=sheared, first=first, last=last, axis=0, how=how)
+    return sheared[rows, cols]
+
+
+def reduce_element(mask, passes, how):
+    # passes from StructuringElement.decompose(); the element is the union
+    # of their windows, so their results are combined with the same AND/OR.
+    ufunc = np.logical_and if how == 'and' else np.logical_or
+    image_ext = None
+    for element_pass in passes:
+        if element_pass[0] == 'diagonal':
+            _, direction, first, last = element_pass
+            pass_ext = reduce_diagonal(mask=mask, first=first, last=last, direction=direction, how=how)
+        else:
+            _, rows, cols = element_pass
+            pass_ext = reduce_rect(mask=mask, rows=rows, cols=cols, how=how)
+        image_ext = pass_ext if image_ext is None else ufunc(image_ext, pass_ext, out=image_ext)
+    return image_ext
@@ -0,0 +1,136 @@
+import threading
+
+import numpy as np
+
+from collections import OrderedDict
+
+from morph_engines import (reduce_rect, reduce_span)
+
+
+def step_canvas(canvas, steps, how):
+    # one more reduction over offsets -steps .. 0 on both axes; a single
+    # step is just the pixel combined with its upper / left neighbour.
+    if steps > 1:
+        return reduce_rect(mask=canvas, rows=(-steps, 0), cols=(-steps, 0), how=how)
+    ufunc = np.logical_and if how == 'and' else np.logical_or
+    rows_ext = np.empty_like(canvas)
+    rows_ext[0] = canvas[0] if how == 'or' else False
+    ufunc(canvas[1:], canvas[:-1], out=rows_ext[1:])
+    canvas_ext = np.empty_like(canvas)
+    canvas_ext[:, 0] = rows_ext[:, 0] if how == 'or' else False
+    ufunc(rows_ext[:, 1:], rows_ext[:, :-1], out=canvas_ext[:, 1:])
+    return canvas_ext
+
+
+class MorphLadder(object):
+    # erode ('and') and dilate ('or') masks of an image at the square
+    # levels it was asked for. The level k window spans offsets
+    # -(k - 2) .. 1, so level k + d is level k followed by a -d .. 0 pass
+    # whose cost does not depend on k. Masks are kept on a canvas with one
+    # extra row and column above and left of the image, the only pixels
+    # outside it that a dilation can reach, which keeps every step exact.
+    def __init__(self, max_bytes=(256 * 1024 ** 2)):
+        self.max_bytes = max_bytes
+        # (digest, how) -> {'current' : last level asked for, 'levels' : {level : canvas}}
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.steps = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def full_canvas(self, mask, level, how):
+        canvas = np.pad(array=mask, pad_width=((1, 0), (1, 0)), mode='constant')
+        reach = (-(level - 2), 1)
+        return reduce_rect(mask=canvas, rows=reach, cols=reach, how=how)
+
+    def seed_canvas(self, mask, result, level, how):
+        # canvas around a result computed elsewhere (e.g. tile by tile)
+        canvas = np.zeros(shape=(mask.shape[0] + 1, mask.shape[1] + 1), dtype=bool)
+        canvas[1:, 1:] = result
+        if how == 'or':
+            # row / column -1 only see the first row / column of the image
+            reach = (-(level - 2), 1)
+            canvas[0, 1:] = reduce_span(mask=mask[0], first=reach[0], last=reach[1], axis=0, how=how)
+            canvas[1:, 0] = reduce_span(mask=mask[:, 0], first=reach[0], last=reach[1], axis=0, how=how)
+            canvas[0, 0] = mask[0, 0]
+        return canvas
+
+    def nearest(self, digest, how, level):
+        # the highest stored level not above `level`
+        with self.lock:
+            ladder = self.entries.get((digest, how))
+            if ladder is None:
+                return None
+            levels = [stored for stored in ladder['levels'] if stored <= level]
+            return max(levels) if levels else None
+
+    def reduce(self, digest, how, level, mask):
+        # mask() gives the thresholded source when nothing lower is stored
+        key = (digest, how)
+        base = self.nearest(digest=digest, how=how, level=level)
+        with self.lock:
+            ladder = self.entries.get(key)
+            base_canvas = None if base is None else ladder['levels'].get(base)
+
+        if base_canvas is None:
+            canvas = self.full_canvas(mask=mask(), level=level, how=how)
+            self.misses += 1
+        elif base == level:
+            canvas = base_canvas
+            self.hits += 1
+        else:
+            canvas = step_canvas(canvas=base_canvas, steps=(level - base), how=how)
+            self.steps += 1
+        self.store(key=key, level=level, canvas=canvas)
+        return canvas[1:, 1:]
+
+    def seed(self, digest, how, level, mask, result):
+        canvas = self.seed_canvas(mask=mask, result=result, level=level, how=how)
+        self.store(key=(digest, how), level=level, canvas=canvas)
+
+    def store(self, key, level, canvas):
+        with self.lock:
+            ladder = self.entries.setdefault(key, {'current' : level, 'levels' : {}})
+            self.entries.move_to_end(key)
+            ladder['current'] = level
+            if level not in ladder['levels']:
+                ladder['levels'][level] = canvas
+                self.n_bytes += canvas.nbytes
+            self.evict(keep=(key, level))
+
+    def evict(self, keep):
+        # least recently used images go first, and within an image the
+        # levels farthest from the one last asked for
+        while self.n_bytes > self.max_bytes:
+            victim = None
+            for key, ladder in self.entries.items():
+                levels = [level for level in ladder['levels'] if (key, level) != keep]
+                if levels:
+                    victim = (key, max(levels, key=lambda level: abs(level - ladder['current'])))
+                    break
+            if victim is None:
+                return None
+            key, level = victim
+            self.n_bytes -= self.entries[key]['levels'].pop(level).nbytes
+            self.evictions += 1
+            if not self.entries[key]['levels']:
+                del self.entries[key]
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits' : self.hits,
+                'steps' : self.steps,
+                'misses' : self.misses,
+                'evictions' : self.evictions,
+                'levels' : sum(len(ladder['levels']) for ladder in self.entries.values()),
+                'bytes' : self.n_bytes,
+            }
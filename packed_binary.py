@@ -0,0 +1,123 @@
+import numpy as np
+
+WORD_BITS = 64
+WORD_DTYPE = np.dtype('<u8')
+
+
+class PackedBinaryImage(object):
+    # rows are stored as little-endian 64-bit words, pixel j living in bit
+    # (j % 64) of word (j // 64), so one AND/OR covers 64 pixels.
+    # Differences such as tophat can go negative where an off-centre window
+    # (level > 3) makes opening non anti-extensive, so they are left to
+    # MorphologicalTransformations instead of being done on the bits.
+    def __init__(self, words, width):
+        self.words = words
+        self.width = width
+        self.height = words.shape[0]
+        self.shape = (self.height, self.width)
+        self.tail_mask = self.get_tail_mask(n_words=words.shape[1], width=width)
+
+    @staticmethod
+    def get_tail_mask(n_words, width):
+        tail_mask = np.full(shape=n_words, fill_value=np.iinfo(WORD_DTYPE).max, dtype=WORD_DTYPE)
+        tail_bits = width % WORD_BITS
+        if n_words and tail_bits:
+            tail_mask[-1] = np.uint64((1 << tail_bits) - 1)
+        return tail_mask
+
+    @classmethod
+    def from_mask(cls, mask):
+        height, width = mask.shape
+        n_words = -(-width // WORD_BITS)
+        packed = np.zeros(shape=(height, n_words * 8), dtype=np.uint8)
+        packed[:, :-(-width // 8)] = np.packbits(mask, axis=1, bitorder='little')
+        return cls(words=packed.view(WORD_DTYPE), width=width)
+
+    @classmethod
+    def from_array(cls, image_src, max_pixel=255):
+        return cls.from_mask(mask=(image_src == max_pixel))
+
+    def to_mask(self):
+        packed = self.words.view(np.uint8)
+        return np.unpackbits(packed, axis=1, count=self.width, bitorder='little').astype(bool)
+
+    def to_array(self, max_pixel=255, min_pixel=0, dtype=np.int64):
+        dtype = np.dtype(dtype)
+        return np.where(self.to_mask(), dtype.type(max_pixel), dtype.type(min_pixel))
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def with_words(self, words):
+        return PackedBinaryImage(words=(words & self.tail_mask), width=self.width)
+
+    def shift_rows(self, words, offset):
+        # out[i] = words[i + offset], background outside the image
+        shifted = np.zeros_like(words)
+        if abs(offset) >= self.height:
+            return shifted
+        if offset >= 0:
+            shifted[:(self.height - offset)] = words[offset:]
+        else:
+            shifted[-offset:] = words[:(self.height + offset)]
+        return shifted
+
+    def shift_cols(self, words, offset):
+        # out[:, j] = pixel (j + offset), background outside the image
+        n_words = words.shape[1]
+        word_off, bit_off = divmod(abs(offset), WORD_BITS)
+        moved = np.zeros_like(words)
+        if word_off < n_words:
+            if offset >= 0:
+                moved[:, :(n_words - word_off)] = words[:, word_off:]
+            else:
+                moved[:, word_off:] = words[:, :(n_words - word_off)]
+        if not bit_off:
+            return moved & self.tail_mask
+
+        bit_off, carry_off = np.uint64(bit_off), np.uint64(WORD_BITS - bit_off)
+        if offset >= 0:
+            shifted = moved >> bit_off
+            shifted[:, :-1] |= moved[:, 1:] << carry_off
+        else:
+            shifted = moved << bit_off
+            shifted[:, 1:] |= moved[:, :-1] >> carry_off
+        return shifted & self.tail_mask
+
+    def reduce_span(self, words, size, step, ufunc, shift):
+        # doubling: after k steps each entry covers 2 ** k consecutive pixels,
+        # two overlapping spans then cover all `size` pixels.
+        span = 1
+        while (span * 2) <= size:
+            words = ufunc(words, shift(words, step * span))
+            span *= 2
+        if span < size:
+            words = ufunc(words, shift(words, step * (size - span)))
+        return words
+
+    def reduce_axis(self, words, before, after, how, shift):
+        # the window is split at the anchor so no shift has to reach for
+        # pixels that were dropped off the edge of the array.
+        ufunc = np.bitwise_and if how == 'and' else np.bitwise_or
+        ahead = self.reduce_span(words, size=(after + 1), step=1, ufunc=ufunc, shift=shift)
+        behind = self.reduce_span(words, size=(before + 1), step=-1, ufunc=ufunc, shift=shift)
+        return ufunc(ahead, behind)
+
+    def reduce_window(self, level, how):
+        before, after = (level - 2), 1
+        words = self.reduce_axis(self.words, before=before, after=after, how=how, shift=self.shift_rows)
+        words = self.reduce_axis(words, before=before, after=after, how=how, shift=self.shift_cols)
+        return self.with_words(words=words)
+
+    def erode(self, level):
+        return self.reduce_window(level=level, how='and')
+
+    def dilate(self, level):
+        return self.reduce_window(level=level, how='or')
+
+    def open(self, level):
+        return self.erode(level=level).dilate(level=level)
+
+    def close(self, level):
+        return self.dilate(level=level).erode(level=level)
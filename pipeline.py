@@ -0,0 +1,240 @@
+import cv2
+import numpy as np
+
+from image_ops_scratch import (ImageOperations, POINTWISE_OPS)
+from image_morphs_scratch import (MorphologicalTransformations, MORPH_GRAPH)
+from jobs import check_cancelled
+from structuring import StructuringElement
+
+GEOMETRIC_OPS = ('flip', 'mirror')
+COLOR_OPS = ('gray', )
+PIPELINE_OPS = POINTWISE_OPS + GEOMETRIC_OPS + COLOR_OPS + tuple(MORPH_GRAPH)
+
+# cv2.flip codes for the (flip, mirror) parity left after cancelling pairs
+FLIP_CODES = {(True, False) : 0, (False, True) : 1, (True, True) : -1}
+
+
+def parse_step(text):
+    name, _, param = text.strip().lower().partition(':')
+    name = name.strip()
+    if name not in PIPELINE_OPS:
+        raise ValueError('Unknown pipeline step - {}'.format(name))
+    if not param.strip():
+        return (name, {})
+    param, _, shape = param.partition(':')
+    if name in MORPH_GRAPH:
+        # e.g. 'open:5' or 'open:7:disk'
+        params = {'level' : int(param)}
+        if shape.strip():
+            # raises for unknown shapes before anything runs
+            StructuringElement.from_name(name=shape.strip(), level=3)
+            params['shape'] = shape.strip()
+        return (name, params)
+    param = int(param)
+    if name in ('binarize', 'solarize'):
+        return (name, {'thresh_val' : param})
+    raise ValueError('Step {} takes no parameter'.format(name))
+
+
+class Pipeline(object):
+    def __init__(self, image_file_src=None, steps=None, engine='vhgw', executor=None):
+        self.image_file_src = image_file_src
+        self.steps = list(steps or [])
+        self.engine = engine
+        self.executor = executor
+        self.imo = ImageOperations(image_file_src=None, executor=executor)
+        self.buffers = {}
+
+    @classmethod
+    def from_text(cls, text, **kwargs):
+        # e.g. 'equalize > binarize > open:5 > boundary'
+        parts = [part for part in text.replace(',', '>').split('>') if part.strip()]
+        return cls(steps=[parse_step(text=part) for part in parts], **kwargs)
+
+    def to_text(self):
+        texts = []
+        for name, params in self.steps:
+            param = params.get('level', params.get('thresh_val'))
+            if params.get('shape', 'square') != 'square':
+                param = '{}:{}'.format(param, params['shape'])
+            texts.append(name if param is None else '{}:{}'.format(name, param))
+        return ' > '.join(texts)
+
+    def add(self, name, **params):
+        self.steps.append((name, params))
+        return self
+
+    def gray(self):
+        return self.add('gray')
+
+    def equalize(self):
+        return self.add('equalize')
+
+    def binarize(self, thresh_val=127):
+        return self.add('binarize', thresh_val=thresh_val)
+
+    def invert(self):
+        return self.add('invert')
+
+    def solarize(self, thresh_val=128):
+        return self.add('solarize', thresh_val=thresh_val)
+
+    def flip(self):
+        return self.add('flip')
+
+    def mirror(self):
+        return self.add('mirror')
+
+    def erode(self, level=3, shape='square'):
+        return self.add('erode', level=level, shape=shape)
+
+    def dilate(self, level=3, shape='square'):
+        return self.add('dilate', level=level, shape=shape)
+
+    def open(self, level=3, shape='square'):
+        return self.add('open', level=level, shape=shape)
+
+    def close(self, level=3, shape='square'):
+        return self.add('close', level=level, shape=shape)
+
+    def gradient(self, level=3, shape='square'):
+        return self.add('gradient', level=level, shape=shape)
+
+    def boundary(self, level=3, shape='square'):
+        return self.add('boundary', level=level, shape=shape)
+
+    def tophat(self, level=3, shape='square'):
+        return self.add('tophat', level=level, shape=shape)
+
+    def blackhat(self, level=3, shape='square'):
+        return self.add('blackhat', level=level, shape=shape)
+
+    def optimize(self, ndim=3):
+        # flips commute with every per-pixel step, so only their parity is
+        # kept and applied once before the next morphology step (whose
+        # window is not symmetric) or at the end. Adjacent pointwise steps
+        # merge into one lookup table.
+        stages = []
+        lut_steps = []
+        flips = [False, False]
+        binary = False
+
+        def flush_lut():
+            if lut_steps:
+                stages.append(('lut', list(lut_steps)))
+                del lut_steps[:]
+
+        def flush_flips():
+            if any(flips):
+                stages.append(('flip', tuple(flips)))
+                flips[0] = flips[1] = False
+
+        for name, params in self.steps:
+            if name in POINTWISE_OPS:
+                lut_steps.append((name, params))
+                binary = False
+            elif name in GEOMETRIC_OPS:
+                flips[GEOMETRIC_OPS.index(name)] ^= True
+            elif name == 'gray':
+                if ndim == 3:
+                    flush_lut()
+                    stages.append(('gray', 'bgr'))
+                    ndim = 2
+            else:
+                if ndim == 3:
+                    flush_lut()
+                    stages.append(('gray', 'rgb'))
+                    ndim = 2
+                # morphology thresholds its input at the mid pixel, which is
+                # just one more lookup table step unless the input is already
+                # the 0/255 output of an earlier morphology step
+                if not binary:
+                    lut_steps.append(('binarize', {'thresh_val' : self.imo.MID_PIXEL}))
+                flush_lut()
+                flush_flips()
+                stages.append(('morph', name, params.get('level', 3), params.get('shape', 'square')))
+                binary = True
+        flush_lut()
+        flush_flips()
+        return stages
+
+    def describe(self, ndim=3):
+        texts = []
+        for stage in self.optimize(ndim=ndim):
+            if stage[0] == 'lut':
+                texts.append('lut({})'.format(', '.join(name for name, _ in stage[1])))
+            elif stage[0] == 'flip':
+                texts.append('flip(code={})'.format(FLIP_CODES[stage[1]]))
+            elif stage[0] == 'gray':
+                texts.append('gray')
+            else:
+                shape = '' if stage[3] == 'square' else ':{}'.format(stage[3])
+                texts.append('{}:{}{}'.format(stage[1], stage[2], shape))
+        return ' > '.join(texts) or 'identity'
+
+    def output_shape(self, shape):
+        # gray and morphology stages drop the channel axis
+        stages = self.optimize(ndim=len(shape))
+        if any(stage[0] in ('gray', 'morph') for stage in stages):
+            return tuple(shape[:2])
+        return tuple(shape)
+
+    def get_buffer(self, shape, slot):
+        # two buffers per shape are enough to ping-pong between stages
+        key = (shape, slot)
+        if key not in self.buffers:
+            self.buffers[key] = np.empty(shape=shape, dtype=np.uint8)
+        return self.buffers[key]
+
+    def target_buffer(self, shape, slot, out):
+        if slot is not None:
+            return self.get_buffer(shape=shape, slot=slot)
+        if (out is not None) and (out.shape == shape):
+            return out
+        return np.empty(shape=shape, dtype=np.uint8)
+
+    def run_stage(self, stage, image_src, slot, out=None):
+        if stage[0] == 'lut':
+            lut = self.imo.compile_lut(steps=stage[1], image_matrix=image_src)
+            if (lut.T == np.arange(256, dtype=np.uint8)).all():
+                return image_src
+            dst = self.target_buffer(shape=image_src.shape, slot=slot, out=out)
+            return self.imo.run_lut(image_src=image_src, lut=lut, out=dst)
+        if stage[0] == 'flip':
+            dst = self.target_buffer(shape=image_src.shape, slot=slot, out=out)
+            return cv2.flip(image_src, FLIP_CODES[stage[1]], dst=dst)
+        if stage[0] == 'gray':
+            code = cv2.COLOR_BGR2GRAY if stage[1] == 'bgr' else cv2.COLOR_RGB2GRAY
+            dst = self.target_buffer(shape=image_src.shape[:2], slot=slot, out=out)
+            return cv2.cvtColor(image_src, code, dst=dst)
+
+        morph = MorphologicalTransformations(
+            image_file_src=None, level=stage[2], engine=self.engine, executor=self.executor, shape=stage[3]
+        )
+        image_morph = morph.evaluate_node(image_src=image_src, node=stage[1])
+        dst = self.target_buffer(shape=image_morph.shape, slot=slot, out=out)
+        dst[...] = np.clip(image_morph, 0, 255, out=image_morph)
+        return dst
+
+    def run(self, image_file_src=None, out=None):
+        image_src = self.image_file_src if image_file_src is None else image_file_src
+        stages = self.optimize(ndim=image_src.ndim)
+
+        image_out, image_slot = image_src, None
+        for index, stage in enumerate(stages):
+            check_cancelled()
+            # intermediate stages write into whichever pooled buffer does not
+            # hold their input, the last one into `out` or a fresh array.
+            is_last = index == (len(stages) - 1)
+            slot = None if is_last else (1 if image_slot == 0 else 0)
+            stage_out = self.run_stage(stage=stage, image_src=image_out, slot=slot, out=out)
+            if stage_out is not image_out:
+                image_out, image_slot = stage_out, slot
+
+        if out is not None:
+            if image_out is not out:
+                out[...] = image_out
+            return out
+        if (image_out is image_src) or (image_slot is not None):
+            return image_out.copy()
+        return image_out
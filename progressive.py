@@ -0,0 +1,5 @@
+def proxy_level(level, scale):
+    # keep the reach of the window, (level - 2) pixels, the same fraction of
+    # the image on the proxy as on the full resolution input.
+    level = 3 if (level == None) or (level <= 3) else level
+    return max(1, int(round((level - 2) * scale))) + 2
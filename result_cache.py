@@ -0,0 +1,169 @@
+import os
+import hashlib
+import threading
+import weakref
+
+import numpy as np
+
+from collections import OrderedDict
+
+
+def image_digest(image_src):
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update('{}|{}'.format(image_src.shape, image_src.dtype.str).encode())
+    hasher.update(np.ascontiguousarray(image_src).data)
+    return hasher.hexdigest()
+
+
+def make_key(digest, name, gray_scale=False, level=None):
+    return (digest, name, bool(gray_scale), level)
+
+
+def key_digest(key):
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+
+
+class ResultCache(object):
+    def __init__(self, max_bytes=(256 * 1024 ** 2), spill_dir=None, spill_max_bytes=(1024 ** 3)):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.spill_max_bytes = spill_max_bytes
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.entries = OrderedDict()
+        self.spilled = OrderedDict()
+        self.n_bytes = 0
+        self.spill_bytes = 0
+        self.digests = {}
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+
+    def digest(self, image_src):
+        # arrays handed out by the cache remember the digest of the key that
+        # produced them, so chained lookups do not rehash any pixels. Only
+        # read-only arrays are remembered, a writeable one may have been
+        # refilled in place since.
+        if not image_src.flags.writeable:
+            with self.lock:
+                known = self.digests.get(id(image_src))
+            if (known is not None) and (known[0]() is image_src):
+                return known[1]
+        digest = image_digest(image_src=image_src)
+        self.remember_digest(image_src=image_src, digest=digest)
+        return digest
+
+    def remember_digest(self, image_src, digest):
+        if image_src.flags.writeable:
+            return None
+        src_id = id(image_src)
+        src_ref = weakref.ref(image_src, lambda ref, src_id=src_id: self.forget_digest(src_id=src_id, src_ref=ref))
+        with self.lock:
+            self.digests[src_id] = (src_ref, digest)
+        return None
+
+    def forget_digest(self, src_id, src_ref):
+        with self.lock:
+            known = self.digests.get(src_id)
+            if (known is not None) and (known[0] is src_ref):
+                self.digests.pop(src_id, None)
+
+    def spill_path(self, key):
+        return os.path.join(self.spill_dir, '{}.npy'.format(key_digest(key=key)))
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+            if key in self.spilled:
+                spill_path, n_bytes = self.spilled.pop(key)
+                self.spill_bytes -= n_bytes
+                try:
+                    value = np.load(spill_path)
+                    os.remove(spill_path)
+                except OSError:
+                    value = None
+                if value is not None:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self.put(key=key, value=value)
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        # a value larger than the whole budget would only flush every other
+        # entry before being evicted itself, so it is at most spilled
+        value.flags.writeable = False
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key).nbytes
+            self.remember_digest(image_src=value, digest=key_digest(key=key))
+            if value.nbytes > self.max_bytes:
+                self.spill(key=key, value=value)
+                return value
+            self.entries[key] = value
+            self.n_bytes += value.nbytes
+            self.remember_digest(image_src=value, digest=key_digest(key=key))
+
+            while (self.n_bytes > self.max_bytes) and self.entries:
+                old_key, old_value = self.entries.popitem(last=False)
+                self.n_bytes -= old_value.nbytes
+                self.evictions += 1
+                self.spill(key=old_key, value=old_value)
+        return value
+
+    def spill(self, key, value):
+        if (self.spill_dir is None) or (value.nbytes > self.spill_max_bytes):
+            return None
+        spill_path = self.spill_path(key=key)
+        try:
+            np.save(spill_path, np.ascontiguousarray(value))
+        except OSError:
+            return None
+        self.spilled[key] = (spill_path, value.nbytes)
+        self.spill_bytes += value.nbytes
+
+        while self.spill_bytes > self.spill_max_bytes:
+            _, (old_path, n_bytes) = self.spilled.popitem(last=False)
+            self.spill_bytes -= n_bytes
+            if os.path.exists(old_path):
+                os.remove(old_path)
+        return spill_path
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key=key)
+        if value is None:
+            value = self.put(key=key, value=compute())
+        return value
+
+    def clear(self):
+        with self.lock:
+            for spill_path, _ in self.spilled.values():
+                if os.path.exists(spill_path):
+                    os.remove(spill_path)
+            self.entries.clear()
+            self.spilled.clear()
+            self.n_bytes = 0
+            self.spill_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'disk_hits' : self.disk_hits,
+                'evictions' : self.evictions,
+                'entries' : len(self.entries),
+                'bytes' : self.n_bytes,
+                'spilled_entries' : len(self.spilled),
+                'spilled_bytes' : self.spill_bytes,
+            }
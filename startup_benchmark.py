@@ -0,0 +1,109 @@
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+from collections import defaultdict
+
+from benchmark import environment_info
+
+# run in a fresh interpreter per repeat, so nothing is imported yet
+FIRST_RESPONSE_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import {module}
+imported = time.perf_counter()
+client = {module}.server.test_client()
+for path in ('/', '/_dash-layout', '/_dash-dependencies'):
+    client.get(path)
+    if path == '/':
+        first = time.perf_counter()
+print(json.dumps({{'import_s' : imported - start, 'first_response_s' : first - start, 'ready_s' : time.perf_counter() - start}}))
+'''
+
+
+def parse_importtime(stderr):
+    # (name, depth, self seconds, cumulative seconds) per line of -X importtime
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append((name.strip(), depth, int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return modules
+
+
+def time_imports(module, python=sys.executable):
+    completed = subprocess.run(
+        [python, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True
+    )
+    return parse_importtime(stderr=completed.stderr)
+
+
+def time_first_response(module, python=sys.executable):
+    completed = subprocess.run(
+        [python, '-c', FIRST_RESPONSE_SCRIPT.format(module=module)],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True
+    )
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize_imports(runs, module):
+    # median over the runs of what each direct import of `module` costs,
+    # and of the self time of every top level package
+    direct, packages, totals = defaultdict(list), defaultdict(list), []
+    for modules in runs:
+        run_packages = defaultdict(float)
+        for name, depth, self_s, cumulative_s in modules:
+            run_packages[name.split('.')[0]] += self_s
+            if (depth == 0) and (name == module):
+                totals.append(cumulative_s)
+            elif depth == 1:
+                direct[name].append(cumulative_s)
+        for name, self_s in run_packages.items():
+            packages[name].append(self_s)
+    return {
+        'total_s' : statistics.median(totals),
+        'direct_imports' : {name : statistics.median(times) for name, times in direct.items()},
+        'packages' : {name : statistics.median(times) for name, times in packages.items()},
+    }
+
+
+def print_ranking(title, times, top):
+    print(title)
+    for name, seconds in sorted(times.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print('  {:<40} {:>9.1f} ms'.format(name, seconds * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the imports and the first response of a cold server process.')
+    parser.add_argument('--module', default='app', help='module that creates the Dash app as `server`')
+    parser.add_argument('--repeat', type=int, default=5, help='fresh processes per measurement, the median is reported')
+    parser.add_argument('--top', type=int, default=15, help='modules listed per ranking')
+    parser.add_argument('--out', default=None, help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    imports = summarize_imports(runs=[time_imports(module=args.module) for _ in range(args.repeat)], module=args.module)
+    responses = [time_first_response(module=args.module) for _ in range(args.repeat)]
+    startup = {name : statistics.median(run[name] for run in responses) for name in responses[0]}
+
+    print('import {} {:.1f} ms, first response {:.1f} ms, layout served {:.1f} ms'.format(
+        args.module, startup['import_s'] * 1000, startup['first_response_s'] * 1000, startup['ready_s'] * 1000
+    ))
+    print_ranking(title='direct imports of {} (cumulative)'.format(args.module), times=imports['direct_imports'], top=args.top)
+    print_ranking(title='packages (self time)', times=imports['packages'], top=args.top)
+
+    if args.out:
+        report = {'environment' : environment_info(workers=0), 'startup' : startup, 'imports' : imports}
+        with open(args.out, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
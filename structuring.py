@@ -0,0 +1,145 @@
+import hashlib
+
+import cv2
+import numpy as np
+
+STRUCTURING_SHAPES = ('square', 'cross', 'disk', 'line')
+LINE_ANGLES = (0, 45, 90, 135)
+
+
+def footprint_runs(row):
+    # (start, stop) of every run of True values, stop inclusive
+    padded = np.concatenate([[False], row, [False]]).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return [(start, stop - 1) for start, stop in zip(edges[::2], edges[1::2])]
+
+
+class StructuringElement(object):
+    # a footprint plus the pixel it is anchored at; the window of output
+    # pixel (i, j) covers (i + y - anchor_y, j + x - anchor_x) for every
+    # (y, x) of the footprint, and erode/dilate reduce over that window.
+    def __init__(self, footprint, anchor=None, name='custom'):
+        footprint = np.asarray(footprint).astype(bool)
+        if (footprint.ndim != 2) or (not footprint.any()):
+            raise ValueError('A structuring element needs a 2D footprint with at least one pixel')
+        height, width = footprint.shape
+        self.footprint = footprint
+        self.anchor = ((height - 1) // 2, (width - 1) // 2) if anchor is None else tuple(anchor)
+        if not ((0 <= self.anchor[0] < height) and (0 <= self.anchor[1] < width)):
+            raise ValueError('Anchor {} lies outside the footprint'.format(self.anchor))
+        self.name = name
+
+    @classmethod
+    def square(cls, level):
+        # the original kernel: level x level, reaching (level - 2) pixels up
+        # and left of the anchor and 1 pixel down and right
+        return cls(footprint=np.ones(shape=(level, level), dtype=bool), anchor=(level - 2, level - 2), name='square')
+
+    @classmethod
+    def cross(cls, level):
+        footprint = np.zeros(shape=(level, level), dtype=bool)
+        footprint[(level - 1) // 2, :] = True
+        footprint[:, (level - 1) // 2] = True
+        return cls(footprint=footprint, name='cross')
+
+    @classmethod
+    def ellipse(cls, width, height, name='ellipse'):
+        footprint = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (width, height))
+        return cls(footprint=footprint, name=name)
+
+    @classmethod
+    def disk(cls, level):
+        return cls.ellipse(width=level, height=level, name='disk')
+
+    @classmethod
+    def line(cls, level, angle=0):
+        # angle in degrees, counter-clockwise from the horizontal
+        radians = np.deg2rad(angle)
+        dx, dy = np.cos(radians), -np.sin(radians)
+        steps = np.arange(level) - (level - 1) // 2
+        xs = np.rint(steps * dx).astype(int)
+        ys = np.rint(steps * dy).astype(int)
+        footprint = np.zeros(shape=(ys.max() - ys.min() + 1, xs.max() - xs.min() + 1), dtype=bool)
+        footprint[ys - ys.min(), xs - xs.min()] = True
+        return cls(footprint=footprint, anchor=(-ys.min(), -xs.min()), name='line-{:g}'.format(angle))
+
+    @classmethod
+    def from_name(cls, name, level):
+        # 'square', 'cross', 'disk', 'line' or 'line-<angle>'
+        shape, _, angle = name.partition('-')
+        if shape == 'square':
+            return cls.square(level=level)
+        if shape == 'cross':
+            return cls.cross(level=level)
+        if shape == 'disk':
+            return cls.disk(level=level)
+        if shape == 'line':
+            return cls.line(level=level, angle=float(angle or 0))
+        raise ValueError('Unknown structuring element - {}'.format(name))
+
+    @classmethod
+    def parse(cls, text):
+        # rows of 0/1 separated by ';' or new lines, e.g. '010;111;010'
+        rows = [row.strip() for row in text.replace('\n', ';').split(';') if row.strip()]
+        if (not rows) or (len(set(len(row) for row in rows)) != 1) or any(set(row) - set('01') for row in rows):
+            raise ValueError('A custom element is rows of 0 and 1 of equal length, e.g. 010;111;010')
+        return cls(footprint=[[char == '1' for char in row] for row in rows])
+
+    def key(self):
+        if self.name != 'custom':
+            return '{}:{}x{}'.format(self.name, *self.footprint.shape)
+        hasher = hashlib.blake2b(np.packbits(self.footprint).tobytes(), digest_size=8)
+        hasher.update(repr((self.footprint.shape, self.anchor)).encode())
+        return 'custom:{}'.format(hasher.hexdigest())
+
+    def reach(self):
+        # how far (in pixels) the window extends from its anchor
+        height, width = self.footprint.shape
+        anchor_y, anchor_x = self.anchor
+        return max(anchor_y, height - 1 - anchor_y, anchor_x, width - 1 - anchor_x)
+
+    def rectangles(self):
+        # every row run grown to the tallest rectangle that still lies in
+        # the footprint; their union is exactly the footprint.
+        rects = set()
+        for y, row in enumerate(self.footprint):
+            for start, stop in footprint_runs(row=row):
+                top, bottom = y, y
+                while (top > 0) and self.footprint[top - 1, start:(stop + 1)].all():
+                    top -= 1
+                while (bottom < self.footprint.shape[0] - 1) and self.footprint[bottom + 1, start:(stop + 1)].all():
+                    bottom += 1
+                rects.add((top, bottom, start, stop))
+        return sorted(
+            rect for rect in rects if not any(
+                (other != rect) and (other[0] <= rect[0]) and (other[1] >= rect[1]) and
+                (other[2] <= rect[2]) and (other[3] >= rect[3]) for other in rects
+            )
+        )
+
+    def diagonal(self):
+        # (direction, first, last) offsets along the diagonal when the
+        # footprint is a solid 45 or 135 degree line, else None
+        ys, xs = np.nonzero(self.footprint)
+        if len(ys) < 2:
+            return None
+        for direction in (1, -1):
+            if len(set(ys - direction * xs)) == 1:
+                steps = np.sort(ys) - self.anchor[0]
+                if (np.diff(steps) == 1).all() and ((self.anchor[0] - self.anchor[1] * direction) == (ys[0] - direction * xs[0])):
+                    return direction, int(steps[0]), int(steps[-1])
+        return None
+
+    def decompose(self):
+        # passes whose windows union to the footprint. Each one costs a
+        # constant amount per pixel, so the total grows with the number of
+        # passes (1 for squares and lines, O(radius) for disks) instead of
+        # with the footprint area.
+        diagonal = self.diagonal()
+        if diagonal is not None:
+            return [('diagonal', ) + diagonal]
+        anchor_y, anchor_x = self.anchor
+        return [
+            ('rect', (top - anchor_y, bottom - anchor_y), (start - anchor_x, stop - anchor_x))
+            for top, bottom, start, stop in self.rectangles()
+        ]
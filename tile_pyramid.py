@@ -0,0 +1,146 @@
+import math
+import threading
+
+import cv2
+
+from collections import OrderedDict
+
+from image_transport import (IMAGE_FORMATS, display_range, encode_image, to_display)
+
+TILE_SIZE = 256
+
+
+class TilePyramid(object):
+    # power of two levels of one result: level 0 is the full resolution and
+    # level k is 2 ** k times smaller, down to the first level that fits in
+    # a single tile. Only the layout is kept; each tile is cut from its own
+    # region of the result when asked for, so no level is ever built whole.
+    def __init__(self, image_src, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.height, self.width = image_src.shape[:2]
+        self.n_levels = max(1, int(math.ceil(math.log2(max(self.height, self.width) / float(tile_size)))) + 1)
+        # the stretch of 2D results has to be the whole image's, not a tile's
+        self.value_range = display_range(image_src=image_src)
+
+    def info(self):
+        return {'width' : self.width, 'height' : self.height, 'tile_size' : self.tile_size, 'levels' : self.n_levels}
+
+    def grid(self, level):
+        # rows and columns of tiles at `level`
+        scale = 2 ** level
+        level_height = -(-self.height // scale)
+        level_width = -(-self.width // scale)
+        return -(-level_height // self.tile_size), -(-level_width // self.tile_size)
+
+    def tile(self, image_src, level, row, col):
+        # the tile's region of the result, area averaged down by 2 ** level;
+        # edge tiles are cut to the image, so they can be smaller
+        if not (0 <= level < self.n_levels):
+            raise ValueError('No level {} in a {} level pyramid'.format(level, self.n_levels))
+        rows, cols = self.grid(level=level)
+        if not ((0 <= row < rows) and (0 <= col < cols)):
+            raise ValueError('No tile ({}, {}) at level {}'.format(row, col, level))
+        scale = 2 ** level
+        span = self.tile_size * scale
+        region = image_src[(row * span):((row + 1) * span), (col * span):((col + 1) * span)]
+        region = to_display(image_src=region, value_range=self.value_range)
+        if scale == 1:
+            return region
+        height, width = region.shape[:2]
+        return cv2.resize(region, (-(-width // scale), -(-height // scale)), interpolation=cv2.INTER_AREA)
+
+
+class PyramidStore(object):
+    # pyramids of the results kept in a ResultStore, under the same token,
+    # and an LRU of their encoded tiles bounded by `max_bytes`. Nothing here
+    # holds on to a result: once the ResultStore evicts it, its pyramid and
+    # tiles go too.
+    def __init__(self, result_store, tile_size=TILE_SIZE, fmt='png', max_bytes=(128 * 1024 ** 2), max_pyramids=4):
+        if fmt not in IMAGE_FORMATS:
+            raise ValueError('Unknown tile format - {}'.format(fmt))
+        self.result_store = result_store
+        self.tile_size = tile_size
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.max_pyramids = max_pyramids
+        self.pyramids = OrderedDict()
+        self.tiles = OrderedDict()
+        self.n_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def mimetype(self):
+        return IMAGE_FORMATS[self.fmt][1]
+
+    def pyramid(self, token):
+        # (pyramid, result), or (None, None) once the result itself is gone
+        # from the result store
+        image_src = self.result_store.get(token=token)
+        if image_src is None:
+            self.forget(token=token)
+            return None, None
+        with self.lock:
+            pyramid = self.pyramids.get(token)
+            if pyramid is not None:
+                self.pyramids.move_to_end(token)
+                return pyramid, image_src
+        pyramid = TilePyramid(image_src=image_src, tile_size=self.tile_size)
+        with self.lock:
+            pyramid = self.pyramids.setdefault(token, pyramid)
+            while len(self.pyramids) > self.max_pyramids:
+                self.drop(token=next(iter(self.pyramids)))
+        return pyramid, image_src
+
+    def drop(self, token):
+        # called with the lock held
+        self.pyramids.pop(token, None)
+        for key in [key for key in self.tiles if key[0] == token]:
+            self.n_bytes -= len(self.tiles.pop(key))
+        return None
+
+    def forget(self, token):
+        with self.lock:
+            if token in self.pyramids:
+                self.drop(token=token)
+        return None
+
+    def info(self, token):
+        pyramid, _ = self.pyramid(token=token)
+        return None if pyramid is None else pyramid.info()
+
+    def tile_bytes(self, token, level, row, col):
+        # None once the result is gone, even where its tiles were cached
+        pyramid, image_src = self.pyramid(token=token)
+        if pyramid is None:
+            return None
+        key = (token, level, row, col)
+        with self.lock:
+            encoded = self.tiles.get(key)
+            if encoded is not None:
+                self.tiles.move_to_end(key)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+
+        tile = pyramid.tile(image_src=image_src, level=level, row=row, col=col)
+        encoded = encode_image(image_src=tile, fmt=self.fmt)
+        with self.lock:
+            if (token in self.pyramids) and (key not in self.tiles):
+                self.tiles[key] = encoded
+                self.n_bytes += len(encoded)
+            while (self.n_bytes > self.max_bytes) and self.tiles:
+                _, old_encoded = self.tiles.popitem(last=False)
+                self.n_bytes -= len(old_encoded)
+        return encoded
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits' : self.hits,
+                'misses' : self.misses,
+                'tiles' : len(self.tiles),
+                'bytes' : self.n_bytes,
+                'pyramids' : len(self.pyramids),
+            }
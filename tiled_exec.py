@@ -0,0 +1,92 @@
+import os
+import threading
+
+import numpy as np
+
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor)
+
+from jobs import (JobCancelled, check_cancelled)
+
+TILE_BACKENDS = ('thread', 'process')
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class TiledExecutor(object):
+    def __init__(self, workers=None, tile_shape=(512, None), backend='thread', min_pixels=(1024 ** 2)):
+        if backend not in TILE_BACKENDS:
+            raise ValueError('Unknown tile backend - {}'.format(backend))
+        self.workers = workers or available_cpus()
+        # (rows, cols) of a tile; None spans the whole image along that axis
+        self.tile_shape = tile_shape
+        self.backend = backend
+        self.min_pixels = min_pixels
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                pool_class = ThreadPoolExecutor if self.backend == 'thread' else ProcessPoolExecutor
+                self.pool = pool_class(max_workers=self.workers)
+            return self.pool
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+    def split_axis(self, length, tile_len, halo):
+        tile_len = length if not tile_len else tile_len
+        for start in range(0, length, tile_len):
+            stop = min(start + tile_len, length)
+            halo_start, halo_stop = max(start - halo, 0), min(stop + halo, length)
+            yield (slice(start, stop), slice(halo_start, halo_stop), slice(start - halo_start, stop - halo_start))
+
+    def split(self, shape, halo=0):
+        rows, cols = shape[:2]
+        if (rows * cols) < self.min_pixels:
+            return [((slice(0, rows), slice(0, cols)), ) * 3]
+        tiles = []
+        for row_out, row_in, row_crop in self.split_axis(length=rows, tile_len=self.tile_shape[0], halo=halo):
+            for col_out, col_in, col_crop in self.split_axis(length=cols, tile_len=self.tile_shape[1], halo=halo):
+                tiles.append(((row_out, col_out), (row_in, col_in), (row_crop, col_crop)))
+        return tiles
+
+    def is_tiled(self, shape, halo=0):
+        return (self.workers > 1) and (len(self.split(shape=shape, halo=halo)) > 1)
+
+    def run(self, func, image_src, halo=0, args=(), out=None):
+        # func(tile, *args) must give one output pixel per input pixel; the
+        # halo has to cover how far a pixel's result reaches into its
+        # neighbourhood for the stitched output to match a single-tile run.
+        if not self.is_tiled(shape=image_src.shape, halo=halo):
+            image_out = func(image_src, *args)
+            if out is None:
+                return image_out
+            out[...] = image_out
+            return out
+
+        pool = self.get_pool()
+        jobs = [
+            (out_slice, crop_slice, pool.submit(func, image_src[in_slice], *args))
+            for out_slice, in_slice, crop_slice in self.split(shape=image_src.shape, halo=halo)
+        ]
+        try:
+            for out_slice, crop_slice, job in jobs:
+                check_cancelled()
+                tile_out = job.result()
+                if out is None:
+                    out = np.empty(shape=(image_src.shape[:2] + tile_out.shape[2:]), dtype=tile_out.dtype)
+                out[out_slice] = tile_out[crop_slice]
+        except JobCancelled:
+            # tiles not started yet are dropped, running ones finish unused
+            for _, _, job in jobs:
+                job.cancel()
+            raise
+        return out